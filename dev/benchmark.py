@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the mem0 pipeline filters and the ingest script.
+
+Runs Pipeline.inlet and dev/ingest_memories.py against local stand-ins:
+a deterministic fake LLM and embedder with configurable latency and an
+in-memory Qdrant. No OpenRouter, vLLM/LM Studio or Qdrant service is needed.
+Reports p50/p95/p99 inlet latency, adds per second and peak memory at each
+concurrency level. --check-breaker also checks that a write held by an
+open circuit is neither lost nor recorded as stored.
+"""
+
+import os
+
+# Keep mem0 from phoning home before it is imported
+os.environ.setdefault("MEM0_TELEMETRY", "False")
+
+import argparse
+import ast
+import asyncio
+import contextlib
+import hashlib
+import importlib.util
+import json
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from typing import Dict, List, Optional
+
+import numpy as np
+from mem0 import AsyncMemory
+from qdrant_client import QdrantClient
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOPICS = [
+    "favourite food",
+    "home city",
+    "job",
+    "pets",
+    "travel plans",
+    "hobbies",
+    "family",
+    "music taste",
+    "health goals",
+    "current project",
+]
+
+
+class FakeEmbedder:
+    """Deterministic hashed bag-of-words embedder with a fixed per-call latency."""
+
+    def __init__(self, dims: int, latency: float):
+        self.dims = dims
+        self.latency = latency
+        self.config = types.SimpleNamespace(model="bench-embedder", embedding_dims=dims)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def embed(self, text, memory_action=None):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dims
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+
+class FakeLLM:
+    """Answers mem0's fact extraction and memory update prompts deterministically.
+
+    Every user line becomes a fact, and a fact is added unless an identical
+    memory already exists.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_response(self, messages, response_format=None, tools=None, tool_choice="auto"):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        prompt = messages[-1]["content"]
+        if prompt.startswith("Input:"):
+            facts = [
+                line[len("user: ") :].strip()
+                for line in prompt.splitlines()
+                if line.startswith("user: ") and len(line) > len("user: ") + 10
+            ]
+            return json.dumps({"facts": facts})
+
+        blocks = prompt.split("```")
+        try:
+            old_memory = ast.literal_eval(blocks[-4].strip() or "[]")
+            facts = ast.literal_eval(blocks[-2].strip() or "[]")
+        except (IndexError, ValueError, SyntaxError):
+            return json.dumps({"memory": []})
+        known = {item["text"] for item in old_memory}
+        actions = [
+            {"id": str(len(old_memory) + i), "text": fact, "event": "ADD"}
+            for i, fact in enumerate(facts)
+            if fact not in known
+        ]
+        return json.dumps({"memory": actions})
+
+
+class FakeGraph:
+    """In-memory stand-in for mem0's Neo4j graph memory with a fixed latency.
+
+    Each topic a user mentions becomes a relation from the user to the
+    topic, and a search returns the user's relations that share a word with
+    the query, best five first, as mem0's graph search does.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.relations: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def add(self, data, filters):
+        if self.latency:
+            time.sleep(self.latency)
+        text = data.lower()
+        with self._lock:
+            relations = self.relations.setdefault(filters["user_id"], set())
+            for topic in TOPICS:
+                if topic in text:
+                    relations.add((filters["user_id"], "talked_about", topic))
+
+    def search(self, query, filters, limit=100):
+        if self.latency:
+            time.sleep(self.latency)
+        words = set(query.lower().replace("?", " ").split())
+        with self._lock:
+            relations = sorted(self.relations.get(filters["user_id"], ()))
+        matches = [r for r in relations if words & set(r[2].split())][:5]
+        return [
+            {"source": source, "relationship": relationship, "destination": destination}
+            for source, relationship, destination in matches
+        ]
+
+
+def make_memory_class(args, history_db_path: str, stats: Dict[str, int]):
+    """Returns an AsyncMemory subclass that swaps in the local stand-ins."""
+
+    class BenchMemory(AsyncMemory):
+        @classmethod
+        async def from_config(cls, config_dict):
+            # Shallow copy: the config may carry live pooled clients
+            config_dict = dict(config_dict)
+            vector_config = config_dict["vector_store"]["config"]
+            dims = int(vector_config.get("embedding_model_dims") or 1536)
+            config_dict["vector_store"] = {
+                "provider": "qdrant",
+                "config": {
+                    "collection_name": vector_config["collection_name"],
+                    "embedding_model_dims": dims,
+                    "client": QdrantClient(":memory:"),
+                },
+            }
+            config_dict["llm"] = {"provider": "openai", "config": {"api_key": "bench"}}
+            config_dict["embedder"] = {
+                "provider": "openai",
+                "config": {"api_key": "bench", "embedding_dims": dims},
+            }
+            config_dict["history_db_path"] = history_db_path
+            memory = await super().from_config(config_dict)
+            memory.embedding_model = FakeEmbedder(dims, args.embed_latency)
+            memory.llm = FakeLLM(args.llm_latency)
+            if args.vector_latency:
+                search = memory.vector_store.search
+
+                def slow_search(*a, **kw):
+                    time.sleep(args.vector_latency)
+                    return search(*a, **kw)
+
+                memory.vector_store.search = slow_search
+            return memory
+
+        async def add(self, messages, **kwargs):
+            result = await super().add(messages, **kwargs)
+            stats["add_calls"] += 1
+            stats["messages_added"] += len(messages) if isinstance(messages, list) else 1
+            return result
+
+    return BenchMemory
+
+
+def load_module(name: str, path: str):
+    if "schemas" not in sys.modules:
+        try:
+            import schemas  # noqa: F401  (provided by the pipelines server)
+        except ImportError:
+            shim = types.ModuleType("schemas")
+            shim.OpenAIChatMessage = dict
+            sys.modules["schemas"] = shim
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def make_body(rng: random.Random, user_index: int, turn: int) -> dict:
+    topic = rng.choice(TOPICS)
+    return {
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": f"Earlier question {turn} from user {user_index}"},
+            {
+                "role": "assistant",
+                "content": f"Noted that user {user_index} mentioned their {rng.choice(TOPICS)} on turn {turn}.",
+            },
+            {
+                "role": "user",
+                "content": f"My {topic} changed again, what do you remember about my {topic}?",
+            },
+        ],
+        "metadata": {"chat_id": f"bench-chat-{user_index}"},
+    }
+
+
+async def bench_inlet(args, filter_path: str, concurrency: int, workdir: str) -> dict:
+    """Drives Pipeline.inlet at a given concurrency and drains its write queue."""
+    stats = {"add_calls": 0, "messages_added": 0}
+    module = load_module(f"bench_filter_{concurrency}", filter_path)
+    module.AsyncMemory = make_memory_class(
+        args, os.path.join(workdir, f"history-{concurrency}.db"), stats
+    )
+    # Pooled clients are built before mem0 sees the config; keep them local too
+    module.QdrantClient = lambda **kwargs: QdrantClient(":memory:")
+    module.Pipeline.build_graph = lambda self, config: FakeGraph(args.graph_latency)
+    pipeline = module.Pipeline()
+    if hasattr(pipeline.valves, "ledger_path"):
+        pipeline.valves.ledger_path = os.path.join(workdir, f"ledger-{concurrency}.db")
+    if hasattr(pipeline.valves, "metrics_path"):
+        pipeline.valves.metrics_path = ""
+    if hasattr(pipeline.valves, "collection_shards"):
+        pipeline.valves.collection_shards = args.collection_shards
+    if hasattr(pipeline.valves, "graph_enabled"):
+        pipeline.valves.graph_enabled = args.graph
+
+    rng = random.Random(args.seed)
+    bodies = [
+        (make_body(rng, i % args.users, i // args.users), {"id": f"bench-user-{i % args.users}"})
+        for i in range(args.requests)
+    ]
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(body, user):
+        async with semaphore:
+            start = time.perf_counter()
+            await pipeline.inlet(body, user)
+            latencies.append(time.perf_counter() - start)
+
+    # Build and warm the client outside the measured window, as a running server would
+    await pipeline.on_startup()
+    await pipeline.inlet(*bodies[0])
+    if hasattr(pipeline, "close_write_queue"):
+        await pipeline.close_write_queue()
+    stats.update(add_calls=0, messages_added=0)
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    await asyncio.gather(*(one(body, user) for body, user in bodies))
+    inlet_elapsed = time.perf_counter() - start
+    await pipeline.on_shutdown()
+    total_elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "inlet_per_s": len(latencies) / inlet_elapsed if inlet_elapsed else 0.0,
+        "add_calls": stats["add_calls"],
+        "adds_per_s": stats["add_calls"] / total_elapsed if total_elapsed else 0.0,
+        "messages_added_per_s": stats["messages_added"] / total_elapsed if total_elapsed else 0.0,
+        "peak_memory_mb": peak / 2**20,
+    }
+
+
+async def check_breaker(args, filter_path: str, workdir: str) -> dict:
+    """Opens the vector_store circuit in the middle of a background add.
+
+    The filter must hold the batch while the store is down, keep its message
+    out of the ledger, and store it once the store is back.
+    """
+    stats = {"add_calls": 0, "messages_added": 0}
+    module = load_module("bench_breaker", filter_path)
+    module.AsyncMemory = make_memory_class(
+        args, os.path.join(workdir, "history-breaker.db"), stats
+    )
+    module.QdrantClient = lambda **kwargs: QdrantClient(":memory:")
+    pipeline = module.Pipeline()
+    ledger_path = os.path.join(workdir, "ledger-breaker.db")
+    pipeline.valves.ledger_path = ledger_path
+    pipeline.valves.metrics_path = ""
+    pipeline.valves.prefetch_enabled = False
+    pipeline.valves.breaker_failure_threshold = 1
+    pipeline.valves.breaker_reset_timeout = 0.1
+    memory = await pipeline.get_memory()
+
+    # Searches still work, so the add gets as far as storing its facts
+    client = memory.vector_store.client
+    upsert = client.upsert
+    outage = threading.Event()
+    outage.set()
+
+    def flaky_upsert(*a, **kw):
+        if outage.is_set():
+            raise ConnectionError("vector store unavailable")
+        return upsert(*a, **kw)
+
+    client.upsert = flaky_upsert
+
+    def stored() -> int:
+        with contextlib.closing(sqlite3.connect(ledger_path)) as db:
+            return db.execute("SELECT COUNT(*) FROM ingested").fetchone()[0]
+
+    body = {
+        "messages": [{"role": "user", "content": "My favourite food is sushi with extra wasabi"}],
+        "metadata": {"chat_id": "bench-breaker"},
+    }
+    await pipeline.inlet(body, {"id": "bench-user-breaker"})
+    queue = pipeline.write_queue
+    deadline = time.monotonic() + 10.0
+    while (
+        not pipeline.metrics.snapshot()["counters"].get("circuit_held_writes")
+        and time.monotonic() < deadline
+    ):
+        await asyncio.sleep(0.05)
+    held = pipeline.metrics.snapshot()["counters"].get("circuit_held_writes", 0)
+    stored_during = stored()
+    failed_during = queue.failed
+
+    outage.clear()
+    await pipeline.on_shutdown()
+    points = client.count(memory.vector_store.collection_name).count
+    result = {
+        "held_writes": held,
+        "ledger_rows_during_outage": stored_during,
+        "failed_during_outage": failed_during,
+        "ledger_rows_after": stored(),
+        "written": queue.written,
+        "failed": queue.failed,
+        "points": points,
+    }
+    result["passed"] = bool(
+        held
+        and not stored_during
+        and not failed_during
+        and result["ledger_rows_after"] == 1
+        and queue.written == 1
+        and not queue.failed
+        and points
+    )
+    return result
+
+
+def write_export(path: str, sessions: int, users: int, messages: int, seed: int):
+    rng = random.Random(seed)
+    data = []
+    for i in range(sessions):
+        history = {}
+        for j in range(messages):
+            role = "user" if j % 2 == 0 else "assistant"
+            history[f"m{i}-{j}"] = {
+                "role": role,
+                "content": f"Session {i} turn {j}: my {rng.choice(TOPICS)} is {rng.randint(0, 99)}",
+                "timestamp": 1_700_000_000 + i * 1000 + j,
+            }
+        data.append(
+            {
+                "id": f"bench-chat-{i}",
+                "user_id": f"bench-user-{i % users}",
+                "chat": {"history": {"messages": history}},
+            }
+        )
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+async def bench_ingest(args, workdir: str, extra_args: Optional[List[str]] = None) -> dict:
+    """Runs dev/ingest_memories.py main() on a synthetic export."""
+    stats = {"add_calls": 0, "messages_added": 0}
+    module = load_module(
+        "bench_ingest", os.path.join(REPO_ROOT, "dev", "ingest_memories.py")
+    )
+    module.AsyncMemory = make_memory_class(
+        args, os.path.join(workdir, "history-ingest.db"), stats
+    )
+    module.QdrantClient = lambda **kwargs: QdrantClient(":memory:")
+    module.COLLECTION_SHARDS = args.collection_shards
+    # Raw mode upserts points directly and never calls add; count those instead
+    store = module.BulkLoader._store
+
+    def counted_store(self, rows):
+        store(self, rows)
+        stats["messages_added"] += len(rows)
+
+    module.BulkLoader._store = counted_store
+    export_path = os.path.join(workdir, "export.json")
+    write_export(
+        export_path, args.ingest_sessions, args.users, args.ingest_messages, args.seed
+    )
+    argv = ["ingest_memories.py", "-f", export_path, "--ledger", "", "--journal", ""] + (extra_args or [])
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    saved_argv, sys.argv = sys.argv, argv
+    start = time.perf_counter()
+    try:
+        await module.main()
+    finally:
+        sys.argv = saved_argv
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+
+    return {
+        "sessions": args.ingest_sessions,
+        "elapsed_s": elapsed,
+        "sessions_per_s": args.ingest_sessions / elapsed if elapsed else 0.0,
+        "add_calls": stats["add_calls"],
+        "adds_per_s": stats["add_calls"] / elapsed if elapsed else 0.0,
+        "messages_added": stats["messages_added"],
+        "messages_added_per_s": stats["messages_added"] / elapsed if elapsed else 0.0,
+        "peak_memory_mb": peak / 2**20,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the mem0 filters and ingest script against local fakes."
+    )
+    parser.add_argument(
+        "--filter",
+        default=os.path.join(REPO_ROOT, "mem0-owui-selfhosted-lmstudio.py"),
+        help="Self-hosted filter file to benchmark.",
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="inlet calls per level.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--embed-latency", type=float, default=0.005)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--vector-latency", type=float, default=0.0)
+    parser.add_argument("--ingest-sessions", type=int, default=50, help="0 skips the ingest benchmark.")
+    parser.add_argument("--ingest-messages", type=int, default=6, help="Messages per exported session.")
+    parser.add_argument("--ingest-raw", action="store_true", help="Benchmark the --raw bulk-load path.")
+    parser.add_argument("--graph", action="store_true", help="Enable graph memory against an in-memory stand-in.")
+    parser.add_argument("--graph-latency", type=float, default=0.02, help="Seconds per graph search or write.")
+    parser.add_argument("--collection-shards", type=int, default=1, help="Collections users are spread over.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--check-breaker",
+        action="store_true",
+        help="Also check that a write held by an open circuit is stored later, and only then.",
+    )
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Skip peak memory tracking.")
+    parser.add_argument("--output", help="Write the results as JSON to this path.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show filter and ingest output.")
+    args = parser.parse_args()
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    results = {"config": vars(args), "inlet": [], "ingest": None, "breaker": None}
+    with tempfile.TemporaryDirectory() as workdir:
+        for concurrency in args.concurrency:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+                sys.stdout if args.verbose else devnull
+            ):
+                result = await bench_inlet(args, args.filter, concurrency, workdir)
+            results["inlet"].append(result)
+            print(
+                f"inlet c={concurrency:<4} p50={result['p50_ms']:8.2f}ms "
+                f"p95={result['p95_ms']:8.2f}ms p99={result['p99_ms']:8.2f}ms "
+                f"inlet/s={result['inlet_per_s']:8.1f} adds/s={result['adds_per_s']:7.1f} "
+                f"peak={result['peak_memory_mb']:.1f}MB"
+            )
+
+        if args.ingest_sessions > 0:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+                sys.stdout if args.verbose else devnull
+            ):
+                result = await bench_ingest(
+                    args, workdir, ["--raw"] if args.ingest_raw else None
+                )
+            results["ingest"] = result
+            # Raw mode stores messages as points without add calls
+            throughput = (
+                f"upserted msgs/s={result['messages_added_per_s']:.1f}"
+                if args.ingest_raw
+                else f"adds/s={result['adds_per_s']:.1f} msgs/s={result['messages_added_per_s']:.1f}"
+            )
+            print(
+                f"ingest sessions={result['sessions']} elapsed={result['elapsed_s']:.2f}s "
+                f"sessions/s={result['sessions_per_s']:.1f} {throughput} "
+                f"peak={result['peak_memory_mb']:.1f}MB"
+            )
+
+        if args.check_breaker:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+                sys.stdout if args.verbose else devnull
+            ):
+                result = await check_breaker(args, args.filter, workdir)
+            results["breaker"] = result
+            print(
+                f"breaker held={result['held_writes']} "
+                f"ledger rows during outage={result['ledger_rows_during_outage']} "
+                f"after={result['ledger_rows_after']} written={result['written']} "
+                f"failed={result['failed']} {'ok' if result['passed'] else 'FAILED'}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if results["breaker"] and not results["breaker"]["passed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
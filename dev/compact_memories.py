@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Compact each user's mem0 memories.
+
+Clusters a user's memories by vector similarity, merges every cluster of
+near-duplicates into one memory and deletes the rest, then reports how many
+vectors were removed. Reads the same environment configuration as
+dev/ingest_memories.py, which also holds the MemoryCompactor the filters
+mirror. Vector store, embedder and LLM calls are rate-limited so a run can
+share the backends with live traffic.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict
+
+from ingest_memories import MemoryCompactor, init_mem_zero
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Merge near-duplicate mem0 memories per user.")
+    parser.add_argument("--user", action="append", help="User to compact (repeatable). Defaults to every user.")
+    parser.add_argument("--threshold", type=float, default=0.92, help="Cosine similarity at which memories are redundant.")
+    parser.add_argument("--no-llm", action="store_true", help="Keep the newest memory of each cluster instead of merging.")
+    parser.add_argument("--io-rate", type=float, default=20.0, help="Vector store and embedder calls per second (0 for no limit).")
+    parser.add_argument("--llm-rate", type=float, default=1.0, help="LLM calls per second (0 for no limit).")
+    parser.add_argument("--max-memories", type=int, default=2000, help="Most memories per user considered.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be removed without changing anything.")
+    parser.add_argument("--output", help="Write the per-user report as JSON to this path.")
+    args = parser.parse_args()
+
+    memory = await init_mem_zero()
+    compactor = MemoryCompactor(
+        threshold=args.threshold,
+        use_llm=not args.no_llm,
+        io_rate=args.io_rate,
+        llm_rate=args.llm_rate,
+        max_memories=args.max_memories,
+        dry_run=args.dry_run,
+    )
+    users = args.user or await compactor.users(memory)
+    print(f"Compacting memories for {len(users)} user(s)")
+
+    start = time.monotonic()
+    reports: Dict[str, Dict[str, int]] = {}
+    for user_id in users:
+        try:
+            reports[user_id] = report = await compactor.compact_user(memory, user_id)
+        except Exception as e:
+            print(f"Compaction failed for user {user_id}: {str(e)}")
+            continue
+        if report["clusters"]:
+            print(
+                f"User {user_id}: {report['scanned']} memories, {report['clusters']} redundant "
+                f"clusters, {report['merged']} merged, {report['removed']} removed"
+            )
+
+    removed = sum(r["removed"] for r in reports.values())
+    scanned = sum(r["scanned"] for r in reports.values())
+    verb = "Would remove" if args.dry_run else "Removed"
+    print(
+        f"{verb} {removed} of {scanned} vectors across {len(reports)} user(s) "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -7,11 +7,31 @@ Reads configuration from environment variables similar to the mem0 pipeline filt
 
 import argparse
 import asyncio
+import bisect
+import codecs
+import functools
+import hashlib
 import json
 import os
-from typing import Dict, List, Optional, Tuple
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Awaitable, Callable, ClassVar, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import httpx
+import numpy as np
+import pytz
 from mem0 import AsyncMemory
+from mem0.memory.utils import remove_code_blocks
+from mem0.vector_stores.qdrant import Qdrant
+from qdrant_client import QdrantClient, models
 
 
 # --- Configuration (Read from Environment Variables) ---
@@ -19,9 +39,26 @@ from mem0 import AsyncMemory
 # Vector store config
 QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
 QDRANT_PORT = os.getenv("QDRANT_PORT", "6333")
+# Populate an embedded (local mode) store in this directory instead of a server
+QDRANT_PATH = os.getenv("QDRANT_PATH", "")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "mem1024")
 EMBEDDING_MODEL_DIMS = int(os.getenv("EMBEDDING_MODEL_DIMS", 1024))
 ON_DISK = os.getenv("ON_DISK", "True").lower() == "true"
+QDRANT_TIMEOUT = int(os.getenv("QDRANT_TIMEOUT", 10))
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "False").lower() == "true"
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+QDRANT_USER_INDEX = os.getenv("QDRANT_USER_INDEX", "True").lower() == "true"
+# Users are spread over this many collections by a hash of their ID
+COLLECTION_SHARDS = int(os.getenv("COLLECTION_SHARDS", 1))
+
+# Index config (QUANTIZATION is none, scalar or binary; HNSW_EF=0 uses ef_construct)
+QUANTIZATION = os.getenv("QUANTIZATION", "none")
+QUANTIZATION_ALWAYS_RAM = os.getenv("QUANTIZATION_ALWAYS_RAM", "True").lower() == "true"
+QUANTIZATION_RESCORE = os.getenv("QUANTIZATION_RESCORE", "True").lower() == "true"
+QUANTIZATION_OVERSAMPLING = float(os.getenv("QUANTIZATION_OVERSAMPLING", 2.0))
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCT = int(os.getenv("HNSW_EF_CONSTRUCT", 100))
+HNSW_EF = int(os.getenv("HNSW_EF", 0))
 
 # LLM config
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
@@ -35,15 +72,631 @@ EMBEDDER_BASE_URL = os.getenv("EMBEDDER_BASE_URL", "http://localhost:8000/v1")
 EMBEDDER_API_KEY = os.getenv("EMBEDDER_API_KEY", "placeholder")
 EMBEDDER_MODEL = os.getenv("EMBEDDER_MODEL", "BAAI/bge-m3")
 
+# Connection pools (the LLM and embedder share one, Qdrant has its own)
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", 100))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("MAX_KEEPALIVE_CONNECTIONS", 20))
+KEEPALIVE_EXPIRY = float(os.getenv("KEEPALIVE_EXPIRY", 30.0))
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 60.0))
+
+# Embedding cache (size 0 disables; path shares vectors with the filters)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+
+# Ingestion ledger shared with the pipeline filters (empty to disable)
+LEDGER_PATH = os.getenv("LEDGER_PATH", "mem0_ledger.db")
+# Days a stored message stays in the ledger (0 keeps it forever)
+LEDGER_MAX_AGE_DAYS = float(os.getenv("LEDGER_MAX_AGE_DAYS", "90"))
+
+# Resume journal of finished and failed sessions (empty to disable)
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "mem0_ingest_journal.db")
+
+# Metrics snapshot written at the end of a run (.json for JSON, else Prometheus text)
+METRICS_PATH = os.getenv("METRICS_PATH", "")
+
+
+class IngestionLedger:
+    """Persistent content-hash ledger of messages already sent to mem0.
+
+    Uses the same SQLite schema as the pipeline filters, so pointing
+    LEDGER_PATH at the filter's ledger_path skips messages already
+    stored from live traffic. A claim only reserves
+    messages in memory; they are recorded by commit once stored, so a crash
+    or cancelled write never marks unstored messages as ingested.
+    """
+
+    PRUNE_INTERVAL: ClassVar[float] = 3600.0
+
+    def __init__(self, path: str, max_age: float = 0.0):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._reserved: set = set()
+        self._next_prune = 0.0
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ingested ("
+            "user_id TEXT NOT NULL, chat_id TEXT NOT NULL, digest BLOB NOT NULL, "
+            "stored_at REAL NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (user_id, chat_id, digest)) WITHOUT ROWID"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(ingested)")]
+        if "stored_at" not in columns:
+            # Ledgers written before pruning existed start their clock now
+            self._conn.execute(
+                "ALTER TABLE ingested ADD COLUMN stored_at REAL NOT NULL DEFAULT 0"
+            )
+            self._conn.execute("UPDATE ingested SET stored_at = ?", (time.time(),))
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ingested_stored_at ON ingested (stored_at)"
+        )
+        self.prune()
+
+    @staticmethod
+    def digest(message: dict, occurrence: int = 0) -> bytes:
+        content = f"{message.get('role')}\0{message.get('content')}"
+        if occurrence:
+            # Repeats of a message within one chat get keys of their own
+            content += f"\0{occurrence}"
+        return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+    @classmethod
+    def digests(cls, messages: List[dict]) -> List[bytes]:
+        """Digests of a conversation's messages, numbering repeated messages."""
+        seen: Dict[bytes, int] = {}
+        digests = []
+        for message in messages:
+            first = cls.digest(message)
+            digests.append(cls.digest(message, seen.get(first, 0)))
+            seen[first] = seen.get(first, 0) + 1
+        return digests
+
+    @staticmethod
+    def occurrence(messages: List[dict], index: int) -> int:
+        """How often messages[index] already appeared earlier in the conversation."""
+        message = messages[index]
+        return sum(
+            1
+            for earlier in messages[:index]
+            if earlier.get("role") == message.get("role")
+            and earlier.get("content") == message.get("content")
+        )
+
+    @staticmethod
+    def chat_key(chat_id: Optional[str], messages: List[dict]) -> str:
+        """The chat ID, or a hash of the opening message for chats without one."""
+        if chat_id:
+            return chat_id
+        first = next((m for m in messages if m.get("role") != "system"), None)
+        if first is None:
+            return ""
+        opening = f"{first.get('role')}\0{first.get('content')}"
+        return "#" + hashlib.blake2b(opening.encode(), digest_size=8).hexdigest()
+
+    def claim(self, user_id: str, chat_id: str, digests: List[bytes]) -> List[int]:
+        """Reserves digests not stored or reserved yet and returns their positions."""
+        positions = []
+        with self._lock:
+            for i, digest in enumerate(digests):
+                key = (user_id, chat_id, digest)
+                if key in self._reserved:
+                    continue
+                if self._conn.execute(
+                    "SELECT 1 FROM ingested WHERE user_id = ? AND chat_id = ? AND digest = ?",
+                    key,
+                ).fetchone():
+                    continue
+                self._reserved.add(key)
+                positions.append(i)
+        return positions
+
+    def commit(self, user_id: str, chat_id: str, digests: List[bytes]):
+        """Records claimed messages as stored."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ingested VALUES (?, ?, ?, ?)",
+                [(user_id, chat_id, digest, now) for digest in digests],
+            )
+            self._reserved.difference_update(
+                (user_id, chat_id, digest) for digest in digests
+            )
+        if now >= self._next_prune:
+            self.prune()
+
+    def release(self, user_id: str, chat_id: str, digests: List[bytes]):
+        """Drops claims whose write failed so the messages can be ingested again."""
+        with self._lock:
+            self._reserved.difference_update(
+                (user_id, chat_id, digest) for digest in digests
+            )
+
+    def prune(self):
+        """Forgets messages stored more than max_age seconds ago."""
+        self._next_prune = time.time() + self.PRUNE_INTERVAL
+        if self.max_age > 0:
+            with self._lock:
+                self._conn.execute(
+                    "DELETE FROM ingested WHERE stored_at < ?",
+                    (time.time() - self.max_age,),
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BackendFailures:
+    """Records backend errors raised while a memory add is in progress.
+
+    mem0 logs and swallows failures of the update LLM call and of the vector
+    store writes, so add returns normally even when nothing was stored.
+    Tracked methods note their errors for the add collecting in the current
+    context (mem0's worker threads inherit it), and the caller checks them
+    once add returns.
+    """
+
+    _current: ClassVar[ContextVar] = ContextVar("backend_failures", default=None)
+
+    @classmethod
+    @contextmanager
+    def collect(cls):
+        """Yields the list of errors raised by tracked methods in this block."""
+        failures: List[Exception] = []
+        token = cls._current.set(failures)
+        try:
+            yield failures
+        finally:
+            cls._current.reset(token)
+
+    @classmethod
+    def track(cls, obj, method: str):
+        """Replace obj.method with a version that records its errors."""
+        original = getattr(obj, method)
+
+        @functools.wraps(original)
+        def tracked(*args, **kwargs):
+            try:
+                return original(*args, **kwargs)
+            except Exception as e:
+                failures = cls._current.get()
+                if failures is not None:
+                    failures.append(e)
+                raise
+
+        setattr(obj, method, tracked)
+
+
+class Metrics:
+    """Thread-safe counters and per-stage latency histograms.
+
+    Recording is a bisect and a few dict updates under a lock. Stats
+    providers are only evaluated when a snapshot is taken, so queue and
+    cache figures cost nothing on the hot path.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, prefix: str = "mem0_owui"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        # stage -> [per-bucket counts (last is +Inf), sum, count]
+        self._stages: Dict[str, list] = {}
+        self._providers: Dict[str, Callable[[], dict]] = {}
+
+    def inc(self, event: str, amount: float = 1):
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + amount
+
+    def observe(self, stage: str, seconds: float):
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, stage: str):
+        """Time the enclosed block as stage, counting stage_errors on exceptions."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f"{stage}_errors")
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def instrument(self, obj, method: str, stage: str):
+        """Replace obj.method with a version timed as stage."""
+        original = getattr(obj, method)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            with self.time(stage):
+                return original(*args, **kwargs)
+
+        setattr(obj, method, timed)
+
+    def register(self, name: str, provider: Callable[[], dict]):
+        """Register a callable returning numeric stats, read at snapshot time."""
+        self._providers[name] = provider
+
+    def _quantile(self, counts: List[int], total: int, q: float) -> float:
+        # Upper bound of the bucket holding the quantile
+        rank, seen = q * total, 0
+        for bound, count in zip(self.BUCKETS, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            stages = {k: (list(v[0]), v[1], v[2]) for k, v in self._stages.items()}
+        gauges = {}
+        for name, provider in self._providers.items():
+            try:
+                for key, value in (provider() or {}).items():
+                    gauges[f"{name}_{key}"] = value
+            except Exception as e:
+                print(f"Metrics provider {name} failed: {str(e)}")
+        return {
+            "counters": counters,
+            "gauges": gauges,
+            "stages": {
+                stage: {
+                    "count": count,
+                    "sum": total,
+                    "mean": total / count if count else 0.0,
+                    "p50": self._quantile(counts, count, 0.50),
+                    "p95": self._quantile(counts, count, 0.95),
+                    "p99": self._quantile(counts, count, 0.99),
+                    "buckets": counts,
+                }
+                for stage, (counts, total, count) in stages.items()
+            },
+        }
+
+    def render_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        p = self.prefix
+        lines = [f"# TYPE {p}_events_total counter"]
+        for event, value in sorted(snapshot["counters"].items()):
+            lines.append(f'{p}_events_total{{event="{event}"}} {value}')
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {float(value)}")
+        lines.append(f"# TYPE {p}_stage_seconds histogram")
+        for stage, data in sorted(snapshot["stages"].items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), data["buckets"]):
+                cumulative += count
+                lines.append(
+                    f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {data["sum"]}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {data["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """Atomically write a snapshot, as JSON for .json paths and Prometheus text otherwise."""
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.render_prometheus()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics(prefix="mem0_ingest")
+
+
+class LockedQdrantLocal:
+    """Serializes calls into Qdrant's local mode, which is not thread-safe.
+
+    mem0 reaches the vector store from worker threads, and concurrent
+    upserts corrupt the local segments.
+    """
+
+    def __init__(self, local):
+        self._local = local
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._local, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class ShardedVectorStore:
+    """Routes mem0 vector store calls to one of several collections by user.
+
+    Each user's memories live in the collection picked by a stable hash of
+    the user ID, so a search only scans that user's shard. Calls made by
+    memory ID alone find the shard through a bounded ID map, falling back to
+    asking each shard in turn.
+    """
+
+    def __init__(self, shards: List[Any], max_ids: int = 100000):
+        self.shards = shards
+        self.max_ids = max_ids
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.shards[0], name)
+
+    @staticmethod
+    def shard_index(user_id: str, count: int) -> int:
+        digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % count
+
+    def _user_shard(self, values: Optional[dict]) -> Optional[int]:
+        if values and values.get("user_id") is not None:
+            return self.shard_index(values["user_id"], len(self.shards))
+        return None
+
+    def _remember(self, vector_id, index: int):
+        with self._lock:
+            self._ids[str(vector_id)] = index
+            self._ids.move_to_end(str(vector_id))
+            while len(self._ids) > self.max_ids:
+                self._ids.popitem(last=False)
+
+    def _find(self, vector_id) -> Optional[Tuple[int, Any]]:
+        with self._lock:
+            index = self._ids.get(str(vector_id))
+        candidates = range(len(self.shards)) if index is None else [index]
+        for i in candidates:
+            record = self.shards[i].get(vector_id=vector_id)
+            if record is not None:
+                self._remember(vector_id, i)
+                return i, record
+        return None
+
+    def insert(self, vectors: list, payloads: list = None, ids: list = None):
+        groups: Dict[int, List[int]] = {}
+        for position in range(len(vectors)):
+            index = self._user_shard(payloads[position] if payloads else None)
+            groups.setdefault(0 if index is None else index, []).append(position)
+        for index, positions in groups.items():
+            shard_ids = [ids[p] for p in positions] if ids else None
+            self.shards[index].insert(
+                vectors=[vectors[p] for p in positions],
+                payloads=[payloads[p] for p in positions] if payloads else None,
+                ids=shard_ids,
+            )
+            for vector_id in shard_ids or []:
+                self._remember(vector_id, index)
+
+    def search(self, query: str, vectors: list, limit: int = 5, filters: dict = None):
+        index = self._user_shard(filters)
+        if index is not None:
+            hits = self.shards[index].search(
+                query=query, vectors=vectors, limit=limit, filters=filters
+            )
+            for hit in hits:
+                self._remember(hit.id, index)
+            return hits
+        hits = [
+            hit
+            for shard in self.shards
+            for hit in shard.search(query=query, vectors=vectors, limit=limit, filters=filters)
+        ]
+        return sorted(hits, key=lambda hit: hit.score, reverse=True)[:limit]
+
+    def get(self, vector_id):
+        found = self._find(vector_id)
+        return found[1] if found else None
+
+    def update(self, vector_id, vector: list = None, payload: dict = None):
+        index = self._user_shard(payload)
+        if index is None:
+            found = self._find(vector_id)
+            index = found[0] if found else 0
+        self.shards[index].update(vector_id=vector_id, vector=vector, payload=payload)
+
+    def delete(self, vector_id):
+        found = self._find(vector_id)
+        if found is not None:
+            self.shards[found[0]].delete(vector_id=vector_id)
+            with self._lock:
+                self._ids.pop(str(vector_id), None)
+
+    def list(self, filters: dict = None, limit: int = 100):
+        index = self._user_shard(filters)
+        if index is not None:
+            return self.shards[index].list(filters=filters, limit=limit)
+        points = [
+            point
+            for shard in self.shards
+            for point in shard.list(filters=filters, limit=limit)[0]
+        ]
+        return points[:limit], None
+
+    def delete_col(self):
+        for shard in self.shards:
+            shard.delete_col()
+
+    def reset(self):
+        for shard in self.shards:
+            shard.reset()
+
+
+def index_user_field(store):
+    # Tenant indexes need Qdrant 1.11+; older servers get a plain keyword index
+    schemas = [
+        models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True),
+        models.PayloadSchemaType.KEYWORD,
+    ]
+    for schema in schemas:
+        try:
+            store.client.create_payload_index(
+                collection_name=store.collection_name,
+                field_name="user_id",
+                field_schema=schema,
+            )
+            return
+        except Exception as e:
+            error = e
+    print(f"Could not index user_id on {store.collection_name}: {str(error)}")
+
+
+def quantization_config():
+    if QUANTIZATION == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, always_ram=QUANTIZATION_ALWAYS_RAM
+            )
+        )
+    if QUANTIZATION == "binary":
+        return models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=QUANTIZATION_ALWAYS_RAM)
+        )
+    if QUANTIZATION != "none":
+        print(f"Unknown QUANTIZATION {QUANTIZATION!r}, using none")
+    return None
+
+
+def search_params():
+    quantization = None
+    if quantization_config() is not None:
+        quantization = models.QuantizationSearchParams(
+            rescore=QUANTIZATION_RESCORE, oversampling=QUANTIZATION_OVERSAMPLING
+        )
+    if not HNSW_EF and quantization is None:
+        return None
+    return models.SearchParams(hnsw_ef=HNSW_EF or None, quantization=quantization)
+
+
+def tune_vector_store(store):
+    """Brings the collection's HNSW and quantization settings in line with the config."""
+    try:
+        current = store.client.get_collection(store.collection_name).config
+        changes = {}
+        if (current.hnsw_config.m, current.hnsw_config.ef_construct) != (
+            HNSW_M,
+            HNSW_EF_CONSTRUCT,
+        ):
+            changes["hnsw_config"] = models.HnswConfigDiff(
+                m=HNSW_M, ef_construct=HNSW_EF_CONSTRUCT
+            )
+        quantization = quantization_config()
+        if current.quantization_config != quantization:
+            changes["quantization_config"] = quantization or models.Disabled.DISABLED
+        if changes:
+            store.client.update_collection(
+                collection_name=store.collection_name, **changes
+            )
+            print(f"Updated {store.collection_name}: {', '.join(changes)}")
+    except Exception as e:
+        print(f"Could not tune {store.collection_name}: {str(e)}")
+
+    params = search_params()
+    if params is None:
+        return
+
+    # mem0 searches for related memories on every add; pass the search params
+    def search(query, vectors, limit=5, filters=None):
+        hits = store.client.query_points(
+            collection_name=store.collection_name,
+            query=vectors,
+            query_filter=store._create_filter(filters) if filters else None,
+            limit=limit,
+            search_params=params,
+        )
+        return hits.points
+
+    store.search = search
+
+
+def embedded_qdrant() -> QdrantClient:
+    """Opens Qdrant in local mode inside this process."""
+    if QDRANT_PATH == ":memory:":
+        client = QdrantClient(location=QDRANT_PATH)
+    else:
+        # Calls are serialized below, so the SQLite handle can cross threads
+        client = QdrantClient(path=QDRANT_PATH, force_disable_check_same_thread=True)
+    client._client = LockedQdrantLocal(client._client)
+    return client
+
+
+def partition_vector_store(memory: AsyncMemory):
+    """Indexes and tunes the collection and optionally spreads users over collections."""
+    store = memory.vector_store
+    shards = [store]
+    if COLLECTION_SHARDS > 1:
+        shards = [
+            Qdrant(
+                collection_name=f"{store.collection_name}_{i}",
+                embedding_model_dims=store.embedding_model_dims,
+                client=store.client,
+                on_disk=store.on_disk,
+            )
+            for i in range(COLLECTION_SHARDS)
+        ]
+        memory.vector_store = ShardedVectorStore(shards)
+    if QDRANT_PATH:
+        # Local mode searches exactly and ignores payload indexes
+        return
+    for shard in shards:
+        if QDRANT_USER_INDEX:
+            index_user_field(shard)
+        tune_vector_store(shard)
+
+
+def use_http_pool(component, pool: httpx.Client):
+    """Points an OpenAI-compatible mem0 LLM or embedder at the shared pool."""
+    client = getattr(component, "client", None)
+    if hasattr(client, "with_options"):
+        component.client = client.with_options(
+            http_client=pool, timeout=REQUEST_TIMEOUT
+        )
+
 
 async def init_mem_zero() -> AsyncMemory:
     """Initializes and returns an AsyncMemory client based on environment config."""
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    if QDRANT_PATH:
+        qdrant_client = embedded_qdrant()
+    else:
+        qdrant_client = QdrantClient(
+            host=QDRANT_HOST,
+            port=int(QDRANT_PORT),
+            grpc_port=QDRANT_GRPC_PORT,
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            timeout=QDRANT_TIMEOUT,
+            limits=limits,
+        )
     config = {
         "vector_store": {
             "provider": "qdrant",
             "config": {
                 "host": QDRANT_HOST,
                 "port": QDRANT_PORT,
+                "client": qdrant_client,
                 "collection_name": COLLECTION_NAME,
                 "embedding_model_dims": EMBEDDING_MODEL_DIMS,
                 "on_disk": ON_DISK,
@@ -79,6 +732,26 @@ async def init_mem_zero() -> AsyncMemory:
 
     try:
         memory = await AsyncMemory.from_config(config)
+        pool = httpx.Client(limits=limits)
+        use_http_pool(memory.llm, pool)
+        use_http_pool(memory.embedding_model, pool)
+        partition_vector_store(memory)
+        metrics.instrument(memory.embedding_model, "embed", "embed")
+        metrics.instrument(memory.vector_store, "search", "vector_search")
+        metrics.instrument(memory.vector_store, "insert", "vector_insert")
+        metrics.instrument(memory.vector_store, "update", "vector_update")
+        metrics.instrument(memory.llm, "generate_response", "llm")
+        if EMBEDDING_CACHE_SIZE > 0:
+            memory.embedding_model = CachedEmbedder(
+                memory.embedding_model,
+                max_entries=EMBEDDING_CACHE_SIZE,
+                path=EMBEDDING_CACHE_PATH,
+            )
+        # Outermost, so every error mem0 swallows during an add is seen
+        BackendFailures.track(memory.embedding_model, "embed")
+        for method in ("search", "insert", "update", "delete", "get", "list"):
+            BackendFailures.track(memory.vector_store, method)
+        BackendFailures.track(memory.llm, "generate_response")
         print("Mem0 client initialized successfully.")
         return memory
     except Exception as e:
@@ -86,101 +759,811 @@ async def init_mem_zero() -> AsyncMemory:
         raise
 
 
+class CachedEmbedder:
+    """Memoizes a mem0 embedder's vectors by (model, text hash).
+
+    Wraps the configured embedder with an in-process LRU tier and an optional
+    SQLite tier that survives restarts and can be shared with the ingest script.
+    """
+
+    def __init__(self, embedder, max_entries: int = 10000, path: str = ""):
+        self.embedder = embedder
+        self.model = getattr(embedder.config, "model", None) or type(embedder).__name__
+        self.max_entries = max(1, max_entries)
+        self._lru: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, digest BLOB NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, digest)) WITHOUT ROWID"
+            )
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # Expose config and any provider specific attributes of the wrapped embedder
+        return getattr(self.embedder, name)
+
+    def embed(self, text, memory_action=None):
+        digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        with self._lock:
+            vector = self._lru.get(digest)
+            if vector is not None:
+                self._lru.move_to_end(digest)
+                self.hits += 1
+                return vector
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT vector FROM embeddings WHERE model = ? AND digest = ?",
+                    (self.model, digest),
+                ).fetchone()
+                if row is not None:
+                    vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    self.disk_hits += 1
+                    self._remember(digest, vector)
+                    return vector
+
+        vector = self.embedder.embed(text, memory_action)
+        with self._lock:
+            self.misses += 1
+            self._remember(digest, vector)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (self.model, digest, np.asarray(vector, dtype=np.float32).tobytes()),
+                )
+        return vector
+
+    def _remember(self, digest: bytes, vector: List[float]):
+        self._lru[digest] = vector
+        self._lru.move_to_end(digest)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._lru),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class JsonArrayReader:
+    """Incrementally decodes the items of a top-level JSON array from a file.
+
+    Only the current item and one read chunk are held in memory, so memory
+    use does not grow with the size of the export. Items are decoded in
+    place at a moving offset; the consumed prefix is only dropped when a new
+    chunk is read, which keeps parsing linear in the file size.
+    """
+
+    WHITESPACE: ClassVar[re.Pattern] = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, file_path: str, chunk_size: int = 1 << 20):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(file_path)
+        self.bytes_read = 0
+        self._file = open(file_path, "rb")
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        if self._skip_whitespace() != "[":
+            self._file.close()
+            raise ValueError("Expected JSON data to be a list of chat sessions.")
+        self._pos += 1
+
+    def fraction(self) -> float:
+        # Unparsed characters approximate the bytes still buffered
+        consumed = max(0, self.bytes_read - (len(self._buffer) - self._pos))
+        return consumed / self.size if self.size else 1.0
+
+    def _fill(self, size: int) -> bool:
+        chunk = self._file.read(size)
+        self.bytes_read += len(chunk)
+        self._buffer = self._buffer[self._pos :]
+        self._pos = 0
+        if not chunk:
+            self._eof = True
+            self._buffer += self._decoder.decode(b"", final=True)
+            return False
+        self._buffer += self._decoder.decode(chunk)
+        return True
+
+    def _skip_whitespace(self) -> str:
+        """Skips whitespace and returns the next character ('' at EOF)."""
+        while True:
+            self._pos = self.WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill(self.chunk_size):
+                return self._buffer[self._pos : self._pos + 1]
+
+    def __iter__(self):
+        try:
+            expect_item = True
+            while True:
+                char = self._skip_whitespace()
+                if char == "]":
+                    return
+                if not char:
+                    raise ValueError("Unexpected end of file inside the session list.")
+                if not expect_item:
+                    if char != ",":
+                        raise ValueError(f"Expected ',' between sessions, found {char!r}.")
+                    self._pos += 1
+                    expect_item = True
+                    continue
+                read_size = self.chunk_size
+                while True:
+                    try:
+                        item, end = self._json.raw_decode(self._buffer, self._pos)
+                        # A bare number cut by the chunk boundary may continue in the
+                        # next chunk, so the item must end at a delimiter
+                        if self._eof or (
+                            end < len(self._buffer) and self._buffer[end] in " \t\n\r,]"
+                        ):
+                            break
+                    except json.JSONDecodeError:
+                        # Most likely an item split across chunks; read more and retry
+                        if self._eof:
+                            raise
+                    self._fill(read_size)
+                    read_size *= 2
+                self._pos = end
+                expect_item = False
+                yield item
+        finally:
+            self._file.close()
+
+
+def parse_session(
+    i: int, session
+) -> Optional[Tuple[str, Optional[str], List[Dict[str, str]]]]:
+    """Extracts user ID, chat ID and timestamp-ordered messages from one exported session."""
+    session_user_id = None
+    session_messages = []
+    try:
+        # Ensure the session is a dictionary before accessing keys
+        if not isinstance(session, dict):
+            print(f"Warning: Session {i + 1} is not a dictionary. Skipping.")
+            return None
+
+        # Extract user_id for this specific session
+        session_user_id = session.get("user_id")
+        if not session_user_id:
+            print(
+                f"Warning: Could not find 'user_id' in session {i + 1}. Skipping ingestion for this session."
+            )
+            return None  # Skip if no user_id for this session
+        messages_dict = (
+            session.get("chat", {}).get("history", {}).get("messages", {})
+        )
+        if not messages_dict:
+            print(
+                f"Warning: No messages found in session {i + 1} under chat.history.messages. Skipping."
+            )
+            return None
+
+        # Sort messages by timestamp to maintain order
+        try:
+            sorted_message_items = sorted(
+                messages_dict.items(), key=lambda item: item[1].get("timestamp", 0)
+            )
+        except AttributeError:
+            print(
+                f"Warning: Messages in session {i + 1} are not in the expected format (dict of dicts). Skipping."
+            )
+            return None
+
+        for _, msg_data in sorted_message_items:
+            if not isinstance(msg_data, dict):
+                print(
+                    f"Warning: Message data is not a dictionary in session {i + 1}. Skipping message."
+                )
+                continue
+            role = msg_data.get("role")
+            content = msg_data.get("content")
+            if role in ["user", "assistant"] and content:
+                session_messages.append({"role": role, "content": content})
+
+        if session_messages:
+            print(
+                f"  Prepared session {i + 1} for user '{session_user_id}' with {len(session_messages)} messages."
+            )
+            return (session_user_id, session.get("id"), session_messages)
+        print(
+            f"  No valid user/assistant messages extracted for session {i + 1} (User: {session_user_id})."
+        )
+
+    except KeyError as e:
+        print(
+            f"Warning: Could not find expected key {e} in session {i + 1}. Skipping this session."
+        )
+    except Exception as e:
+        print(
+            f"Warning: Error processing session {i + 1}: {e}. Skipping this session."
+        )
+    return None
+
+
+def iter_sessions_from_json(
+    reader: JsonArrayReader,
+) -> Iterator[Tuple[str, Optional[str], List[Dict[str, str]], int]]:
+    """Yields (user_id, chat_id, messages, index) as sessions are decoded from the export."""
+    try:
+        for i, session in enumerate(reader):
+            parsed = parse_session(i, session)
+            if parsed is not None:
+                yield (*parsed, i)
+    except ValueError as e:
+        # Sessions decoded before the error have already been yielded
+        print(f"Error: Could not decode JSON from {reader.file_path}: {e}")
+
+
 def extract_sessions_from_json(
     file_path: str,
-) -> List[Tuple[Optional[str], List[Dict[str, str]]]]:
-    """Loads JSON data and extracts user ID and messages for each session."""
+) -> List[Tuple[str, Optional[str], List[Dict[str, str]], int]]:
+    """Loads all sessions into a list. Prefer iter_sessions_from_json for large exports."""
     print(f"Loading chat history from {file_path}...")
-    sessions_data = []
     try:
-        with open(file_path, "r") as f:
-            data = json.load(f)
+        reader = JsonArrayReader(file_path)
     except FileNotFoundError:
         print(f"Error: File not found at {file_path}")
         return []
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from {file_path}")
+    except ValueError as e:
+        print(f"Error: {e}")
         return []
+    sessions_data = list(iter_sessions_from_json(reader))
+    print(f"Successfully prepared {len(sessions_data)} sessions for ingestion.")
+    return sessions_data
 
-    if not isinstance(data, list):
-        print("Error: Expected JSON data to be a list of chat sessions.")
-        return []
 
-    if not data:
-        print("Warning: JSON file contains an empty list. No sessions to process.")
-        return []
+def estimate_tokens(message: Dict[str, str]) -> int:
+    """Rough token count of a message (about four characters per token)."""
+    return len(message.get("content", "")) // 4 + 4
 
-    print(f"Found {len(data)} chat session(s) in the export.")
 
-    for i, session in enumerate(data):
-        session_user_id = None
-        session_messages = []
-        try:
-            # Ensure the session is a dictionary before accessing keys
-            if not isinstance(session, dict):
-                print(f"Warning: Session {i + 1} is not a dictionary. Skipping.")
-                continue
+def session_windows(
+    messages: List[Dict[str, str]],
+    max_messages: int = 0,
+    max_tokens: int = 0,
+    overlap: int = 0,
+) -> List[Tuple[int, int]]:
+    """Splits a session into (start, end) windows bounded by message count and
+    estimated tokens, each repeating the last ``overlap`` messages of the
+    previous window. A zero limit disables that bound.
+    """
+    windows = []
+    start = 0
+    prev_end = 0
+    while start < len(messages):
+        end = start
+        tokens = 0
+        while end < len(messages):
+            if max_messages and end - start >= max_messages:
+                break
+            cost = estimate_tokens(messages[end])
+            # Every window gets at least one new message, even when the
+            # overlap or a single oversized message fills the token budget
+            if max_tokens and end > prev_end and tokens + cost > max_tokens:
+                break
+            tokens += cost
+            end += 1
+        windows.append((start, end))
+        if end == len(messages):
+            break
+        prev_end = end
+        start = max(end - overlap, start + 1)
+    return windows
 
-            # Extract user_id for this specific session
-            session_user_id = session.get("user_id")
-            if not session_user_id:
-                print(
-                    f"Warning: Could not find 'user_id' in session {i + 1}. Skipping ingestion for this session."
-                )
-                continue  # Skip if no user_id for this session
-            messages_dict = (
-                session.get("chat", {}).get("history", {}).get("messages", {})
+
+class IngestJournal:
+    """Durable record of which sessions of an export finished or failed.
+
+    Sessions are keyed by chat ID, or by their index in the export when the
+    chat ID is missing. Status updates are buffered and written in one
+    transaction per batch, so the journal stays cheap at high session rates.
+    A crash loses at most the last unflushed batch. The ingestion ledger
+    already stops those messages from being extracted twice.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        export_path: str,
+        flush_every: int = 200,
+        flush_interval: float = 2.0,
+    ):
+        self.export = os.path.abspath(export_path)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "export TEXT NOT NULL, session_key TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL, error TEXT, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (export, session_key)) WITHOUT ROWID"
+        )
+        self.status: Dict[str, str] = dict(
+            self._conn.execute(
+                "SELECT session_key, status FROM sessions WHERE export = ?",
+                (self.export,),
+            ).fetchall()
+        )
+        self._pending: List[tuple] = []
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def key(chat_id: Optional[str], index: int) -> str:
+        return chat_id or f"#{index}"
+
+    def mark(self, key: str, status: str, attempts: int, error: Optional[str] = None):
+        self.status[key] = status
+        self._pending.append(
+            (self.export, key, status, attempts, error, time.time())
+        )
+        if (
+            len(self._pending) >= self.flush_every
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+                self._pending,
             )
-            if not messages_dict:
-                print(
-                    f"Warning: No messages found in session {i + 1} under chat.history.messages. Skipping."
-                )
+            self._conn.execute("COMMIT")
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+class BulkLoader:
+    """Stores raw messages as memories without LLM fact extraction.
+
+    Messages from many sessions are embedded in large batches and upserted
+    into the vector store in bulk. Payloads match what mem0 writes for
+    ``add(..., infer=False)``, so the filters search them like any other
+    memory. A session is never split across flushes, so on_stored reports
+    each session as stored or failed as a whole, and only once its flush
+    has finished. abort drops what is left without reporting it. It first
+    waits for upserts already running in worker threads, and reports the
+    sessions of those that succeed as stored.
+    """
+
+    def __init__(
+        self,
+        memory: AsyncMemory,
+        on_stored: Callable[[tuple, Optional[Exception]], None],
+        batch_size: int = 512,
+        embed_batch_size: int = 64,
+        concurrency: int = 1,
+        retries: int = 0,
+        retry_backoff: float = 2.0,
+    ):
+        self.memory = memory
+        self.on_stored = on_stored
+        self.batch_size = max(1, batch_size)
+        self.embed_batch_size = max(1, embed_batch_size)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._batch: List[Tuple[tuple, List[Tuple[str, dict]]]] = []
+        self._size = 0
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._flushes: set = set()
+        # Store calls in worker threads and their batches; cancelling a flush
+        # does not stop the thread, so its call stays here for abort to settle
+        self._stores: Dict[asyncio.Future, List[Tuple[tuple, List[Tuple[str, dict]]]]] = {}
+
+    @staticmethod
+    def rows(user_id: str, messages: List[Dict[str, str]]) -> List[Tuple[str, dict]]:
+        """Builds (memory_id, payload) pairs the way mem0 does for infer=False."""
+        created_at = datetime.now(pytz.timezone("US/Pacific")).isoformat()
+        rows = []
+        for message in messages:
+            content = message.get("content")
+            if not content or message.get("role") in (None, "system"):
                 continue
+            payload = {
+                "user_id": user_id,
+                "role": message["role"],
+                "data": content,
+                "hash": hashlib.md5(content.encode()).hexdigest(),
+                "created_at": created_at,
+            }
+            if message.get("name"):
+                payload["actor_id"] = message["name"]
+            # IDs are fixed up front so a retried upsert overwrites instead of duplicating
+            rows.append((str(uuid.uuid4()), payload))
+        return rows
 
-            # Sort messages by timestamp to maintain order
+    async def add(self, session: tuple):
+        """Buffers a (user_id, chat_id, messages, index) session for the next flush."""
+        rows = self.rows(session[0], session[2])
+        self._batch.append((session, rows))
+        self._size += len(rows)
+        if self._size >= self.batch_size:
+            await self._start_flush()
+
+    async def close(self):
+        if self._batch:
+            await self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+
+    async def abort(self):
+        """Drops buffered sessions and cancels flushes in flight without reporting them.
+
+        Returns only once the upserts already running have finished, so
+        nothing is written after the caller releases the sessions' claims.
+        """
+        self._batch, self._size = [], 0
+        for task in self._flushes:
+            task.cancel()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        for store, batch in list(self._stores.items()):
             try:
-                sorted_message_items = sorted(
-                    messages_dict.items(), key=lambda item: item[1].get("timestamp", 0)
-                )
-            except AttributeError:
-                print(
-                    f"Warning: Messages in session {i + 1} are not in the expected format (dict of dicts). Skipping."
-                )
+                await store
+            except Exception:
                 continue
+            # Stored after all; reporting it keeps a rerun from adding it again
+            for session, _ in batch:
+                self.on_stored(session, None)
+        self._stores.clear()
+
+    async def _start_flush(self):
+        batch, self._batch, self._size = self._batch, [], 0
+        # Bounds the flushes in flight; the export reader waits here
+        await self._slots.acquire()
+        task = asyncio.create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
 
-            for _, msg_data in sorted_message_items:
-                if not isinstance(msg_data, dict):
+    async def _flush(self, batch: List[Tuple[tuple, List[Tuple[str, dict]]]]):
+        try:
+            rows = [row for _, session_rows in batch for row in session_rows]
+            error = None
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    delay = self.retry_backoff * 2 ** (attempt - 1)
+                    await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                    metrics.inc("session_retries")
+                store = asyncio.ensure_future(asyncio.to_thread(self._store, rows))
+                self._stores[store] = batch
+                try:
+                    # Shielded so a cancelled flush leaves the call for abort
+                    await asyncio.shield(store)
+                except Exception as e:
+                    del self._stores[store]
                     print(
-                        f"Warning: Message data is not a dictionary in session {i + 1}. Skipping message."
+                        f"  Error during bulk load of {len(rows)} messages "
+                        f"(attempt {attempt + 1}/{self.retries + 1}): {e}"
                     )
+                    error = e
                     continue
-                role = msg_data.get("role")
-                content = msg_data.get("content")
-                if role in ["user", "assistant"] and content:
-                    session_messages.append({"role": role, "content": content})
+                del self._stores[store]
+                error = None
+                break
+            for session, _ in batch:
+                self.on_stored(session, error)
+        finally:
+            self._slots.release()
 
-            if session_user_id and session_messages:
-                print(
-                    f"  Prepared session {i + 1} for user '{session_user_id}' with {len(session_messages)} messages."
+    def _store(self, rows: List[Tuple[str, dict]]):
+        for start in range(0, len(rows), self.batch_size):
+            chunk = rows[start : start + self.batch_size]
+            vectors = []
+            for offset in range(0, len(chunk), self.embed_batch_size):
+                texts = [
+                    payload["data"]
+                    for _, payload in chunk[offset : offset + self.embed_batch_size]
+                ]
+                with metrics.time("bulk_embed"):
+                    vectors.extend(self.embed_batch(texts))
+            with metrics.time("bulk_upsert"):
+                self.memory.vector_store.insert(
+                    vectors=vectors,
+                    payloads=[payload for _, payload in chunk],
+                    ids=[memory_id for memory_id, _ in chunk],
                 )
-                sessions_data.append((session_user_id, session_messages))
-            elif session_user_id:
-                print(
-                    f"  No valid user/assistant messages extracted for session {i + 1} (User: {session_user_id})."
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embeds texts in one request when the embedder has an OpenAI-style client."""
+        embedder = self.memory.embedding_model
+        embedder = getattr(embedder, "embedder", embedder)
+        embeddings = getattr(getattr(embedder, "client", None), "embeddings", None)
+        if embeddings is None or not hasattr(embeddings, "create"):
+            return [embedder.embed(text, "add") for text in texts]
+        response = embeddings.create(
+            input=[text.replace("\n", " ") for text in texts],
+            model=embedder.config.model,
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart (a rate of 0 disables it)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+
+class MemoryCompactor:
+    """Merges or deletes a user's near-duplicate memories.
+
+    Memories are clustered greedily, oldest first: each joins the cluster
+    whose first member it is most similar to, if that similarity reaches
+    threshold. With use_llm the LLM rewrites each cluster into one memory,
+    stored over the newest member; without it the newest member is kept as
+    is. The other members are deleted through mem0, so history is recorded.
+    Vector store and embedder calls share io_rate, LLM calls use llm_rate.
+    """
+
+    MERGE_PROMPT: ClassVar[str] = (
+        "The memories below are about the same user and say nearly the same "
+        "thing. They are listed oldest first. Merge them into one concise "
+        "memory that keeps every distinct fact; where they disagree, keep the "
+        'newest. Reply in JSON as {"memory": "<merged memory>"}.\n\n'
+    )
+
+    def __init__(
+        self,
+        threshold: float = 0.92,
+        use_llm: bool = True,
+        io_rate: float = 5.0,
+        llm_rate: float = 0.2,
+        max_memories: int = 2000,
+        dry_run: bool = False,
+        idle: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.threshold = threshold
+        self.use_llm = use_llm
+        self.max_memories = max_memories
+        self.dry_run = dry_run
+        self.idle = idle
+        self.io = RateLimiter(io_rate)
+        self.llm = RateLimiter(llm_rate)
+
+    @staticmethod
+    def stores(memory) -> List:
+        return getattr(memory.vector_store, "shards", None) or [memory.vector_store]
+
+    def user_store(self, memory, user_id: str):
+        stores = self.stores(memory)
+        return stores[ShardedVectorStore.shard_index(user_id, len(stores))]
+
+    async def users(self, memory) -> List[str]:
+        """Every user ID with stored memories."""
+        seen = set()
+        for store in self.stores(memory):
+            offset = None
+            while True:
+                await self.io.wait()
+                page, offset = await asyncio.to_thread(
+                    store.client.scroll,
+                    collection_name=store.collection_name,
+                    limit=1024,
+                    offset=offset,
+                    with_payload=["user_id"],
+                    with_vectors=False,
                 )
-            # Case where session_user_id was missing is handled earlier
+                seen.update(p.payload["user_id"] for p in page if p.payload.get("user_id"))
+                if offset is None:
+                    break
+        return sorted(seen)
 
-        except KeyError as e:
-            print(
-                f"Warning: Could not find expected key {e} in session {i + 1}. Skipping this session."
+    async def load(self, memory, user_id: str) -> List:
+        store = self.user_store(memory, user_id)
+        condition = models.Filter(
+            must=[models.FieldCondition(key="user_id", match=models.MatchValue(value=user_id))]
+        )
+        points, offset = [], None
+        while len(points) < self.max_memories:
+            await self.io.wait()
+            page, offset = await asyncio.to_thread(
+                store.client.scroll,
+                collection_name=store.collection_name,
+                scroll_filter=condition,
+                limit=min(256, self.max_memories - len(points)),
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            points.extend(p for p in page if p.vector and p.payload.get("data"))
+            if offset is None:
+                break
+        return points
+
+    def cluster(self, vectors: np.ndarray) -> List[List[int]]:
+        unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        leaders: List[int] = []
+        clusters: List[List[int]] = []
+        for i in range(len(unit)):
+            if leaders:
+                scores = unit[leaders] @ unit[i]
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    clusters[best].append(i)
+                    continue
+            leaders.append(i)
+            clusters.append([i])
+        return [members for members in clusters if len(members) > 1]
+
+    async def merge(self, memory, texts: List[str]) -> Optional[str]:
+        await self.llm.wait()
+        prompt = self.MERGE_PROMPT + "\n".join(f"- {text}" for text in texts)
+        try:
+            response = await asyncio.to_thread(
+                memory.llm.generate_response,
+                messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"},
             )
+            merged = json.loads(remove_code_blocks(response))["memory"]
         except Exception as e:
-            print(
-                f"Warning: Error processing session {i + 1}: {e}. Skipping this session."
+            print(f"Could not merge {len(texts)} memories: {str(e)}")
+            return None
+        return merged.strip() if isinstance(merged, str) and merged.strip() else None
+
+    async def compact_user(self, memory, user_id: str) -> Dict[str, int]:
+        """Compacts one user's memories and returns what was scanned and removed."""
+        points = await self.load(memory, user_id)
+        points.sort(key=lambda p: p.payload.get("updated_at") or p.payload.get("created_at") or "")
+        report = {"scanned": len(points), "clusters": 0, "merged": 0, "removed": 0}
+        if len(points) < 2:
+            return report
+        clusters = self.cluster(np.asarray([p.vector for p in points], dtype=np.float32))
+        report["clusters"] = len(clusters)
+        for members in clusters:
+            group = [points[i] for i in members]
+            keep, redundant = group[-1], group[:-1]
+            if self.dry_run:
+                report["removed"] += len(redundant)
+                continue
+            text = keep.payload["data"]
+            if self.use_llm:
+                text = await self.merge(memory, [p.payload["data"] for p in group])
+                if text is None:
+                    continue
+            if self.idle is not None:
+                await self.idle()
+            if text != keep.payload["data"]:
+                await self.io.wait()
+                await memory.update(keep.id, text)
+                report["merged"] += 1
+            for point in redundant:
+                await self.io.wait()
+                await memory.delete(point.id)
+                report["removed"] += 1
+        return report
+
+
+class IngestProgress:
+    """Tracks completed sessions and periodically prints throughput and ETA.
+
+    When the session count is unknown (streaming), fraction reports how much
+    of the export has been read and drives the ETA instead.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        total: Optional[int] = None,
+        fraction: Optional[Callable[[], float]] = None,
+    ):
+        self.total = total
+        self.fraction = fraction
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+
+    def line(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        if self.total:
+            completed = self.done / self.total
+            count = f"{self.done}/{self.total} sessions"
+        elif self.fraction is not None:
+            completed = self.fraction()
+            count = f"{self.done} sessions ({completed:.1%} of export read)"
+        else:
+            return f"Progress: {self.done} sessions, {rate:.2f} sessions/s"
+        if completed:
+            eta = time.strftime(
+                "%H:%M:%S", time.gmtime(elapsed * (1 - completed) / completed)
             )
+        else:
+            eta = "?"
+        return f"Progress: {count}, {rate:.2f} sessions/s, ETA {eta}"
 
-    print(f"Successfully prepared {len(sessions_data)} sessions for ingestion.")
-    return sessions_data
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            print(self.line())
+
+
+async def run_per_user_ordered(
+    sessions: Iterable[Tuple[str, Optional[str], List[Dict[str, str]]]],
+    handler: Callable[..., Awaitable[None]],
+    concurrency: int,
+    max_pending: int,
+):
+    """Runs handler over sessions with a bounded worker pool.
+
+    Different users are ingested in parallel while each user's sessions
+    are handled one at a time in export order, so memory updates for a
+    user never race. At most max_pending sessions are buffered.
+    """
+    pending: Dict[str, deque] = {}
+    ready: asyncio.Queue = asyncio.Queue()
+    slots = asyncio.Semaphore(max(max_pending, concurrency))
+
+    async def worker():
+        while True:
+            user_id = await ready.get()
+            session = pending[user_id].popleft()
+            try:
+                await handler(*session)
+            except Exception as e:
+                # A failing session must not take its worker down with it
+                print(f"Unhandled error in session for user '{user_id}': {e}")
+                metrics.inc("sessions_failed")
+            finally:
+                slots.release()
+                # Hand the user back to the pool until their sessions run out
+                if pending[user_id]:
+                    ready.put_nowait(user_id)
+                else:
+                    del pending[user_id]
+                ready.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    try:
+        for session in sessions:
+            await slots.acquire()
+            user_sessions = pending.get(session[0])
+            if user_sessions is None:
+                pending[session[0]] = deque([session])
+                ready.put_nowait(session[0])
+            else:
+                user_sessions.append(session)
+        await ready.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
 
 async def main():
@@ -193,12 +1576,96 @@ async def main():
         required=True,
         help="Path to the Open WebUI JSON export file.",
     )
+    parser.add_argument(
+        "--ledger",
+        default=LEDGER_PATH,
+        help="Path to the ingestion ledger shared with the filters (empty to disable).",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=METRICS_PATH,
+        help="Write a metrics snapshot here when done (.json for JSON, else Prometheus text).",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Users ingested in parallel; each user's sessions stay in order.",
+    )
+    parser.add_argument(
+        "--journal",
+        default=JOURNAL_PATH,
+        help="Resume journal; finished sessions are skipped on rerun (empty to disable).",
+    )
+    parser.add_argument(
+        "--only-failed",
+        action="store_true",
+        help="Only retry sessions the journal records as failed.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="Times to retry a failing session before recording it as failed.",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=2.0,
+        help="Base seconds for exponential backoff between retries.",
+    )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Store messages verbatim in bulk, skipping LLM fact extraction.",
+    )
+    parser.add_argument(
+        "--bulk-batch-size",
+        type=int,
+        default=512,
+        help="Messages per bulk upsert in --raw mode.",
+    )
+    parser.add_argument(
+        "--embed-batch-size",
+        type=int,
+        default=64,
+        help="Texts per embedding request in --raw mode.",
+    )
+    parser.add_argument(
+        "--window-messages",
+        type=int,
+        default=0,
+        help="Split sessions into windows of at most this many messages (0 to disable).",
+    )
+    parser.add_argument(
+        "--window-tokens",
+        type=int,
+        default=0,
+        help="Split sessions into windows of at most this many estimated tokens (0 to disable).",
+    )
+    parser.add_argument(
+        "--window-overlap",
+        type=int,
+        default=0,
+        help="Messages repeated from the end of the previous window for context.",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between progress reports.",
+    )
     args = parser.parse_args()
 
-    extracted_sessions = extract_sessions_from_json(args.file)
-
-    if not extracted_sessions:
-        print("No valid sessions extracted from the file. Exiting.")
+    print(f"Streaming chat history from {args.file}...")
+    try:
+        reader = JsonArrayReader(args.file)
+    except FileNotFoundError:
+        print(f"Error: File not found at {args.file}")
+        return
+    except ValueError as e:
+        print(f"Error: {e}")
         return
 
     try:
@@ -207,33 +1674,227 @@ async def main():
         print("Failed to initialize mem0 client. Exiting.")
         return
 
-    ingested_count = 0
-    failed_count = 0
-    for session_user_id, session_messages in extracted_sessions:
+    ledger = (
+        IngestionLedger(args.ledger, LEDGER_MAX_AGE_DAYS * 86400) if args.ledger else None
+    )
+    journal = IngestJournal(args.journal, args.file) if args.journal else None
+
+    counts = {"ingested": 0, "skipped": 0, "resumed": 0, "failed": 0}
+    progress = IngestProgress(args.progress_interval, fraction=reader.fraction)
+
+    def sessions_to_run():
+        for session in iter_sessions_from_json(reader):
+            if journal:
+                status = journal.status.get(IngestJournal.key(session[1], session[3]))
+                if status == "done" or (args.only_failed and status != "failed"):
+                    counts["resumed"] += 1
+                    continue
+            yield session
+
+    async def add_with_retries(session_user_id, messages):
+        for attempt in range(args.retries + 1):
+            if attempt:
+                # Exponential backoff with jitter; the user's later sessions wait
+                delay = args.retry_backoff * 2 ** (attempt - 1)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                metrics.inc("session_retries")
+            try:
+                with metrics.time("window_add"), BackendFailures.collect() as failures:
+                    await mem0_client.add(messages=messages, user_id=session_user_id)
+                    if failures:
+                        # mem0 logged and skipped part of the write; retry it
+                        # rather than mark the window stored
+                        raise failures[0]
+                return
+            except Exception as e:
+                print(
+                    f"  Error during mem0 ingestion for user '{session_user_id}' "
+                    f"(attempt {attempt + 1}/{args.retries + 1}): {e}"
+                )
+                if attempt == args.retries:
+                    raise
+
+    # User, ledger chat key and digests of the messages each session has claimed
+    claims: Dict[str, Tuple[str, str, List[bytes]]] = {}
+
+    def claim_session(session_user_id, chat_id, session_messages, key):
+        """Returns the messages still to ingest, or None when nothing is left.
+
+        The ledger only reserves them; they are committed once stored.
+        """
         # Double check, though extraction function should ensure these are present
         if not session_user_id or not session_messages:
             print(
                 "Skipping session due to missing user ID or messages (should not happen here)."
             )
-            failed_count += 1
-            continue
+            counts["failed"] += 1
+            return None
 
-        print(
-            f"Ingesting session for user '{session_user_id}' ({len(session_messages)} messages)..."
+        if ledger:
+            chat_key = IngestionLedger.chat_key(chat_id, session_messages)
+            digests = IngestionLedger.digests(session_messages)
+            positions = ledger.claim(session_user_id, chat_key, digests)
+            claims[key] = (session_user_id, chat_key, [digests[i] for i in positions])
+            session_messages = [session_messages[i] for i in positions]
+            if not session_messages:
+                del claims[key]
+                print(f"Skipping already ingested session for user '{session_user_id}'.")
+                counts["skipped"] += 1
+                metrics.inc("sessions_skipped")
+                if journal:
+                    journal.mark(key, "done", 0)
+                return None
+        return session_messages
+
+    def settle_claims(key, stored: int):
+        """Commits the first stored claimed messages of a session and releases the rest."""
+        session_user_id, chat_key, digests = claims.pop(key, (None, None, []))
+        if ledger and digests:
+            ledger.commit(session_user_id, chat_key, digests[:stored])
+            ledger.release(session_user_id, chat_key, digests[stored:])
+
+    def session_stored(session, error):
+        session_user_id, chat_id, session_messages, index = session
+        key = IngestJournal.key(chat_id, index)
+        progress.done += 1
+        settle_claims(key, 0 if error is not None else len(session_messages))
+        if error is not None:
+            counts["failed"] += 1
+            metrics.inc("sessions_failed")
+            if journal:
+                journal.mark(key, "failed", args.retries + 1, str(error))
+            return
+        counts["ingested"] += 1
+        metrics.inc("sessions_ingested")
+        metrics.inc("messages_ingested", len(session_messages))
+        if journal:
+            journal.mark(key, "done", 1)
+
+    async def bulk_load():
+        # Raw memories have no LLM update step, so per-user order does not
+        # matter and sessions are batched in export order instead
+        loader = BulkLoader(
+            mem0_client,
+            session_stored,
+            batch_size=args.bulk_batch_size,
+            embed_batch_size=args.embed_batch_size,
+            concurrency=args.concurrency,
+            retries=args.retries,
+            retry_backoff=args.retry_backoff,
         )
         try:
-            # Ingest messages for the current session
-            await mem0_client.add(messages=session_messages, user_id=session_user_id)
+            for session_user_id, chat_id, session_messages, index in sessions_to_run():
+                key = IngestJournal.key(chat_id, index)
+                session_messages = claim_session(
+                    session_user_id, chat_id, session_messages, key
+                )
+                if session_messages is None:
+                    progress.done += 1
+                    continue
+                await loader.add((session_user_id, chat_id, session_messages, index))
+            await loader.close()
+        except BaseException:
+            # Sessions buffered or mid-flush were never confirmed stored;
+            # releasing them lets a rerun pick them up again
+            await loader.abort()
+            for key in list(claims):
+                settle_claims(key, 0)
+            raise
+
+    async def ingest_session(session_user_id, chat_id, session_messages, index):
+        key = IngestJournal.key(chat_id, index)
+        try:
+            session_messages = claim_session(
+                session_user_id, chat_id, session_messages, key
+            )
+            if session_messages is None:
+                return
+
+            windows = session_windows(
+                session_messages,
+                args.window_messages,
+                args.window_tokens,
+                args.window_overlap,
+            )
+            print(
+                f"Ingesting session for user '{session_user_id}' "
+                f"({len(session_messages)} messages, {len(windows)} windows)..."
+            )
+            # Messages before this index are stored; windows run in order so
+            # extraction sees the conversation as it happened
+            ingested = 0
+            try:
+                with metrics.time("session_add"):
+                    for start, end in windows:
+                        await add_with_retries(
+                            session_user_id, session_messages[start:end]
+                        )
+                        ingested = end
+                        metrics.inc("windows_ingested")
+            except Exception as e:
+                # Only the unsent tail is released, so a rerun resumes after
+                # the last stored window
+                settle_claims(key, ingested)
+                counts["failed"] += 1
+                metrics.inc("sessions_failed")
+                metrics.inc("messages_ingested", ingested)
+                if journal:
+                    journal.mark(key, "failed", args.retries + 1, str(e))
+                return
+            except BaseException:
+                # Cancelled or interrupted: nothing after the last stored
+                # window may stay claimed, or a rerun would skip it
+                settle_claims(key, ingested)
+                raise
+
+            settle_claims(key, len(session_messages))
             print(f"  Successfully ingested session for user '{session_user_id}'.")
-            ingested_count += 1
-        except Exception as e:
-            print(f"  Error during mem0 ingestion for user '{session_user_id}': {e}")
-            failed_count += 1
+            counts["ingested"] += 1
+            metrics.inc("sessions_ingested")
+            metrics.inc("messages_ingested", len(session_messages))
+            if journal:
+                journal.mark(key, "done", 1)
+        finally:
+            progress.done += 1
+
+    reporter = asyncio.create_task(progress.report())
+    try:
+        if args.raw:
+            await bulk_load()
+        else:
+            await run_per_user_ordered(
+                sessions_to_run(),
+                ingest_session,
+                concurrency=args.concurrency,
+                max_pending=args.concurrency * 4,
+            )
+    finally:
+        reporter.cancel()
+        # Flushes the journal's buffered marks even when the run is interrupted
+        if ledger:
+            ledger.close()
+        if journal:
+            journal.close()
+    print(progress.line())
 
     print("\n--- Ingestion Summary ---")
-    print(f"Successfully ingested sessions: {ingested_count}")
-    print(f"Failed to ingest sessions: {failed_count}")
-    print(f"Total sessions processed: {len(extracted_sessions)}")
+    print(f"Successfully ingested sessions: {counts['ingested']}")
+    print(f"Already ingested sessions skipped: {counts['skipped']}")
+    print(f"Sessions skipped by the resume journal: {counts['resumed']}")
+    print(f"Failed to ingest sessions: {counts['failed']}")
+    print(f"Total sessions processed: {progress.done}")
+    if not progress.done:
+        print("No valid sessions extracted from the file.")
+
+    print("\n--- Stage Latency (seconds) ---")
+    for stage, data in sorted(metrics.snapshot()["stages"].items()):
+        print(
+            f"{stage}: count={data['count']} mean={data['mean']:.3f} "
+            f"p50<={data['p50']} p95<={data['p95']} p99<={data['p99']}"
+        )
+    if args.metrics_file:
+        metrics.dump(args.metrics_file)
+        print(f"Metrics written to {args.metrics_file}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Recall/latency sweep for Qdrant quantization and HNSW settings.
+
+Builds one scratch collection per (quantization, m, ef_construct) setting,
+loads the same vectors into each and runs the same queries at every
+search-time ef. Reports recall@k against exact (brute-force) search, p50/p99
+search latency, build time and the RAM/disk footprint of each setting, so
+the index valves of the self-hosted filters can be picked with numbers.
+
+Vectors are either sampled from an existing collection (--source-collection)
+or generated as normalized clusters of the configured dimension.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from qdrant_client import QdrantClient, models
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def synthetic_vectors(count: int, dims: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    # Embeddings cluster by topic; uniform noise would make every index look bad
+    centers = normalize(rng.standard_normal((clusters, dims), dtype=np.float32))
+    labels = rng.integers(0, clusters, count)
+    noise = rng.standard_normal((count, dims), dtype=np.float32) * (1.5 / np.sqrt(dims))
+    return normalize(centers[labels] + noise).astype(np.float32)
+
+
+def sample_collection(client: QdrantClient, collection: str, limit: int) -> np.ndarray:
+    vectors, offset = [], None
+    while len(vectors) < limit:
+        points, offset = client.scroll(
+            collection_name=collection,
+            limit=min(256, limit - len(vectors)),
+            offset=offset,
+            with_payload=False,
+            with_vectors=True,
+        )
+        vectors.extend(point.vector for point in points)
+        if offset is None:
+            break
+    return normalize(np.asarray(vectors, dtype=np.float32))
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    # Vectors are normalized, so cosine similarity is a dot product
+    truth = []
+    for start in range(0, len(queries), 64):
+        scores = queries[start : start + 64] @ vectors.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        truth.extend(set(row.tolist()) for row in top)
+    return truth
+
+
+def quantization_config(name: str, always_ram: bool):
+    if name == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, always_ram=always_ram)
+        )
+    if name == "binary":
+        return models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=always_ram)
+        )
+    return None
+
+
+def estimate_ram(args, count: int, dims: int, quantization: str, m: int) -> float:
+    """Rough resident size in MB: originals, quantized copies and the HNSW graph."""
+    size = 0 if args.on_disk else count * dims * 4
+    if quantization != "none" and args.always_ram:
+        size += count * dims if quantization == "scalar" else count * ((dims + 7) // 8)
+    # Layer 0 holds up to 2*m four-byte links per point; upper layers add little
+    size += count * 2 * m * 4
+    return size / 1e6
+
+
+def directory_size(path: str) -> Optional[float]:
+    if not os.path.isdir(path):
+        return None
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total / 1e6
+
+
+def wait_for_index(client: QdrantClient, collection: str, count: int, timeout: float, local: bool) -> bool:
+    # Local mode has no HNSW index and always searches exactly
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = client.get_collection(collection)
+        if info.status == models.CollectionStatus.GREEN and (
+            local or (info.indexed_vectors_count or 0) >= count
+        ):
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def build_collection(args, client: QdrantClient, name: str, vectors: np.ndarray, quantization: str, m: int, ef_construct: int) -> dict:
+    if client.collection_exists(name):
+        client.delete_collection(name)
+    started = time.perf_counter()
+    client.create_collection(
+        collection_name=name,
+        vectors_config=models.VectorParams(
+            size=vectors.shape[1], distance=models.Distance.COSINE, on_disk=args.on_disk
+        ),
+        hnsw_config=models.HnswConfigDiff(m=m, ef_construct=ef_construct),
+        quantization_config=quantization_config(quantization, args.always_ram),
+        # Index every segment, however small, so the sweep never measures a full scan
+        optimizers_config=models.OptimizersConfigDiff(indexing_threshold=1),
+    )
+    for start in range(0, len(vectors), args.batch_size):
+        batch = vectors[start : start + args.batch_size]
+        client.upsert(
+            collection_name=name,
+            points=models.Batch(
+                ids=list(range(start, start + len(batch))), vectors=batch.tolist()
+            ),
+            wait=True,
+        )
+    indexed = wait_for_index(client, name, len(vectors), args.index_timeout, bool(args.path))
+    return {"build_seconds": time.perf_counter() - started, "indexed": indexed}
+
+
+def run_queries(args, client: QdrantClient, name: str, queries: np.ndarray, truth: List[set], quantization: str, ef: int) -> dict:
+    params = models.SearchParams(
+        hnsw_ef=ef,
+        quantization=(
+            models.QuantizationSearchParams(
+                rescore=not args.no_rescore, oversampling=args.oversampling
+            )
+            if quantization != "none"
+            else None
+        ),
+    )
+    latencies, recalls = [], []
+    for i, query in enumerate(queries):
+        vector = query.tolist()
+        started = time.perf_counter()
+        hits = client.query_points(
+            collection_name=name, query=vector, limit=args.k, search_params=params
+        ).points
+        latencies.append(time.perf_counter() - started)
+        recalls.append(len({hit.id for hit in hits} & truth[i]) / args.k)
+    return {
+        "recall": sum(recalls) / len(recalls),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:6333", help="Qdrant server to sweep on.")
+    parser.add_argument("--path", help="Use local-mode Qdrant in this directory instead (exact search only).")
+    parser.add_argument("--source-collection", help="Sample vectors from this collection instead of generating them.")
+    parser.add_argument("--points", type=int, default=20000, help="Vectors loaded into each collection.")
+    parser.add_argument("--dims", type=int, default=1024, help="Dimension of generated vectors.")
+    parser.add_argument("--clusters", type=int, default=200, help="Topic clusters of generated vectors.")
+    parser.add_argument("--queries", type=int, default=200, help="Held-out query vectors.")
+    parser.add_argument("-k", type=int, default=10, help="Results per query; recall is measured at k.")
+    parser.add_argument("--quantization", nargs="+", default=["none", "scalar", "binary"], choices=["none", "scalar", "binary"])
+    parser.add_argument("--m", type=int, nargs="+", default=[16])
+    parser.add_argument("--ef-construct", type=int, nargs="+", default=[100])
+    parser.add_argument("--ef", type=int, nargs="+", default=[32, 64, 128, 256], help="Search-time ef values.")
+    parser.add_argument("--oversampling", type=float, default=2.0)
+    parser.add_argument("--no-rescore", action="store_true", help="Return quantized scores without rescoring.")
+    parser.add_argument("--on-disk", action="store_true", help="Keep original vectors on disk, as on_disk does.")
+    parser.add_argument("--no-always-ram", dest="always_ram", action="store_false", help="Let quantized vectors go to disk too.")
+    parser.add_argument("--storage-path", help="Qdrant storage directory, to measure each collection on disk.")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--index-timeout", type=float, default=600.0, help="Seconds to wait for indexing.")
+    parser.add_argument("--prefix", default="sweep", help="Name prefix of the scratch collections.")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch collections.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this path.")
+    args = parser.parse_args()
+
+    client = QdrantClient(path=args.path) if args.path else QdrantClient(url=args.url, timeout=60)
+    rng = np.random.default_rng(args.seed)
+    if args.source_collection:
+        vectors = sample_collection(client, args.source_collection, args.points + args.queries)
+        if len(vectors) <= args.queries:
+            sys.exit(f"{args.source_collection} has too few points for {args.queries} queries")
+        order = rng.permutation(len(vectors))
+        queries, vectors = vectors[order[: args.queries]], vectors[order[args.queries :]]
+    else:
+        data = synthetic_vectors(args.points + args.queries, args.dims, args.clusters, rng)
+        queries, vectors = data[: args.queries], data[args.queries :]
+    count, dims = vectors.shape
+    print(f"{count} vectors of {dims} dims, {len(queries)} queries, recall@{args.k}")
+    truth = exact_neighbours(vectors, queries, args.k)
+
+    results: List[Dict] = []
+    for quantization in args.quantization:
+        for m in args.m:
+            for ef_construct in args.ef_construct:
+                name = f"{args.prefix}_{quantization}_m{m}_efc{ef_construct}"
+                built = build_collection(args, client, name, vectors, quantization, m, ef_construct)
+                if not built["indexed"]:
+                    print(f"{name}: indexing did not finish in {args.index_timeout}s, results may be a full scan")
+                disk = None
+                if args.storage_path:
+                    disk = directory_size(os.path.join(args.storage_path, "collections", name))
+                elif args.path:
+                    disk = directory_size(os.path.join(args.path, "collection", name))
+                # Warm the caches so the first timed queries are not page faults
+                run_queries(args, client, name, queries[: min(20, len(queries))], truth, quantization, max(args.ef))
+                for ef in args.ef:
+                    row = {
+                        "quantization": quantization,
+                        "m": m,
+                        "ef_construct": ef_construct,
+                        "ef": ef,
+                        **run_queries(args, client, name, queries, truth, quantization, ef),
+                        "ram_mb": estimate_ram(args, count, dims, quantization, m),
+                        "disk_mb": disk,
+                        **built,
+                    }
+                    results.append(row)
+                    disk_text = f"{disk:8.1f}" if disk is not None else "       -"
+                    print(
+                        f"{quantization:<7} m={m:<3} ef_construct={ef_construct:<4} ef={ef:<4} "
+                        f"recall@{args.k}={row['recall']:.3f} p50={row['p50_ms']:7.2f}ms "
+                        f"p99={row['p99_ms']:7.2f}ms ram~{row['ram_mb']:8.1f}MB disk={disk_text}MB "
+                        f"build={row['build_seconds']:.1f}s"
+                    )
+                if not args.keep:
+                    client.delete_collection(name)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"points": count, "dims": dims, "queries": len(queries), "k": args.k, "results": results},
+                f,
+                indent=2,
+            )
+        print(f"Results written to {args.output}")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,328 @@ description: Filter that works with mem0
 requirements: mem0ai, pydantic==2.11.4
 """
 
-from typing import ClassVar, List, Optional
+import os
+import bisect
+import functools
+import inspect
+import json
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Awaitable, Callable, ClassVar, Dict, List, Optional
 from pydantic import BaseModel, Field, model_validator
 from schemas import OpenAIChatMessage
-from mem0 import MemoryClient
+from mem0 import AsyncMemoryClient
+import asyncio
+import httpx
+
+
+class MemoryWriteQueue:
+    """Bounded write-behind queue that coalesces pending messages per user.
+
+    Messages for the same user are grouped into a single write and a user is
+    never written by two workers at once, so memory updates stay ordered.
+    """
+
+    def __init__(
+        self,
+        writer: Callable[[str, List[Any]], Awaitable[None]],
+        max_pending: int = 1000,
+        workers: int = 2,
+        max_batch: int = 20,
+        put_timeout: float = 0.0,
+    ):
+        self.writer = writer
+        self.max_pending = max(1, max_pending)
+        self.worker_count = max(1, workers)
+        self.max_batch = max(1, max_batch)
+        self.put_timeout = put_timeout
+        self._pending: Dict[str, List[Any]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._active: set = set()
+        self._space = asyncio.Condition()
+        self._workers: List[asyncio.Task] = []
+        self.size = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+    def start(self):
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._run()) for _ in range(self.worker_count)
+            ]
+
+    async def put(self, user_id: str, item: Any) -> bool:
+        """Queue an item, waiting up to put_timeout for space. Returns False if dropped."""
+        if self.size >= self.max_pending and self.put_timeout > 0:
+            async with self._space:
+                try:
+                    await asyncio.wait_for(
+                        self._space.wait_for(lambda: self.size < self.max_pending),
+                        self.put_timeout,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        if self.size >= self.max_pending:
+            self.dropped += 1
+            print(f"Memory write queue full, dropped message for user {user_id}")
+            return False
+
+        batch = self._pending.setdefault(user_id, [])
+        batch.append(item)
+        self.size += 1
+        self.enqueued += 1
+        # A user already waiting or being written is re-queued by its worker.
+        if len(batch) == 1 and user_id not in self._active:
+            self._ready.put_nowait(user_id)
+        return True
+
+    async def _run(self):
+        while True:
+            user_id = await self._ready.get()
+            self._active.add(user_id)
+            items = self._pending.pop(user_id, [])
+            batch, rest = items[: self.max_batch], items[self.max_batch :]
+            if rest:
+                self._pending[user_id] = rest
+            self.size -= len(batch)
+            try:
+                await self.writer(user_id, batch)
+                self.written += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"Memory write failed for user {user_id}: {str(e)}")
+            finally:
+                self._active.discard(user_id)
+                if user_id in self._pending:
+                    self._ready.put_nowait(user_id)
+                self._ready.task_done()
+                async with self._space:
+                    self._space.notify_all()
+
+    async def close(self, timeout: Optional[float] = None):
+        """Flush pending writes (bounded by timeout) and stop the workers."""
+        if self._workers:
+            try:
+                await asyncio.wait_for(self._ready.join(), timeout)
+            except asyncio.TimeoutError:
+                print(f"Memory write queue flush timed out, {self.size} messages lost")
+            for task in self._workers:
+                task.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            self._workers = []
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+
+class ContextBuilder:
+    """Packs the most relevant memories into a bounded prompt section.
+
+    Results are ranked by score, filtered by min_score and de-duplicated by
+    word overlap, then added while they fit max_results and the token budget.
+    Tokens are estimated locally at about four characters each.
+    """
+
+    def __init__(
+        self,
+        max_results: int = 10,
+        min_score: float = 0.0,
+        token_budget: int = 1000,
+        duplicate_threshold: float = 0.9,
+    ):
+        self.max_results = max_results
+        self.min_score = min_score
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        return len(text) // 4 + 1
+
+    @staticmethod
+    def words(text: str) -> frozenset:
+        return frozenset(
+            "".join(c if c.isalnum() else " " for c in text.lower()).split()
+        )
+
+    def is_duplicate(self, words: frozenset, kept: List[frozenset]) -> bool:
+        for other in kept:
+            union = len(words | other)
+            if not union or len(words & other) / union >= self.duplicate_threshold:
+                return True
+        return False
+
+    def select(self, results: List[dict]) -> List[str]:
+        """Returns the memory texts to inject, best first."""
+        ranked = sorted(
+            (r for r in results if r.get("memory")),
+            key=lambda r: r.get("score") or 0.0,
+            reverse=True,
+        )
+        selected: List[str] = []
+        kept: List[frozenset] = []
+        used = 0
+        for result in ranked:
+            if self.max_results and len(selected) >= self.max_results:
+                break
+            if (result.get("score") or 0.0) < self.min_score:
+                break
+            words = self.words(result["memory"])
+            if self.is_duplicate(words, kept):
+                continue
+            cost = self.estimate_tokens(result["memory"]) + 2
+            # Skip what does not fit; a shorter, lower ranked memory may still
+            if self.token_budget and used + cost > self.token_budget:
+                continue
+            selected.append(result["memory"])
+            kept.append(words)
+            used += cost
+        return selected
+
+    def build(self, results: List[dict]) -> str:
+        selected = self.select(results)
+        if not selected:
+            return ""
+        return "\n\nRelevant memories:\n" + "\n".join(f"- {m}" for m in selected)
+
+
+class Metrics:
+    """Thread-safe counters and per-stage latency histograms.
+
+    Recording is a bisect and a few dict updates under a lock. Stats
+    providers are only evaluated when a snapshot is taken, so queue and
+    cache figures cost nothing on the hot path.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, prefix: str = "mem0_owui"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        # stage -> [per-bucket counts (last is +Inf), sum, count]
+        self._stages: Dict[str, list] = {}
+        self._providers: Dict[str, Callable[[], dict]] = {}
+
+    def inc(self, event: str, amount: float = 1):
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + amount
+
+    def observe(self, stage: str, seconds: float):
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, stage: str):
+        """Time the enclosed block as stage, counting stage_errors on exceptions."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f"{stage}_errors")
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def instrument(self, obj, method: str, stage: str):
+        """Replace obj.method with a version timed as stage."""
+        original = getattr(obj, method)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            with self.time(stage):
+                return original(*args, **kwargs)
+
+        setattr(obj, method, timed)
+
+    def register(self, name: str, provider: Callable[[], dict]):
+        """Register a callable returning numeric stats, read at snapshot time."""
+        self._providers[name] = provider
+
+    def _quantile(self, counts: List[int], total: int, q: float) -> float:
+        # Upper bound of the bucket holding the quantile
+        rank, seen = q * total, 0
+        for bound, count in zip(self.BUCKETS, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            stages = {k: (list(v[0]), v[1], v[2]) for k, v in self._stages.items()}
+        gauges = {}
+        for name, provider in self._providers.items():
+            try:
+                for key, value in (provider() or {}).items():
+                    gauges[f"{name}_{key}"] = value
+            except Exception as e:
+                print(f"Metrics provider {name} failed: {str(e)}")
+        return {
+            "counters": counters,
+            "gauges": gauges,
+            "stages": {
+                stage: {
+                    "count": count,
+                    "sum": total,
+                    "mean": total / count if count else 0.0,
+                    "p50": self._quantile(counts, count, 0.50),
+                    "p95": self._quantile(counts, count, 0.95),
+                    "p99": self._quantile(counts, count, 0.99),
+                    "buckets": counts,
+                }
+                for stage, (counts, total, count) in stages.items()
+            },
+        }
+
+    def render_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        p = self.prefix
+        lines = [f"# TYPE {p}_events_total counter"]
+        for event, value in sorted(snapshot["counters"].items()):
+            lines.append(f'{p}_events_total{{event="{event}"}} {value}')
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {float(value)}")
+        lines.append(f"# TYPE {p}_stage_seconds histogram")
+        for stage, data in sorted(snapshot["stages"].items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), data["buckets"]):
+                cumulative += count
+                lines.append(
+                    f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {data["sum"]}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {data["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """Atomically write a snapshot, as JSON for .json paths and Prometheus text otherwise."""
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.render_prometheus()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -22,25 +340,204 @@ class Pipeline:
             description="mem0 API key for authentication. Must be set in OpenWebUI dashboard."
         )
         user_id: str = "default_user"
+
+        # HTTP client config
+        max_connections: int = Field(
+            default=100, description="Maximum open connections to the mem0 API"
+        )
+        max_keepalive_connections: int = Field(
+            default=20, description="Idle connections kept alive for reuse"
+        )
+        request_timeout: float = Field(
+            default=30.0, description="Seconds before a mem0 API request times out"
+        )
+
+        # Write queue config
+        write_queue_max_pending: int = Field(
+            default=1000, description="Maximum messages waiting to be written to mem0"
+        )
+        write_queue_workers: int = Field(
+            default=2, description="Number of background mem0 writers"
+        )
+        write_queue_max_batch: int = Field(
+            default=20, description="Maximum messages per user coalesced into one add"
+        )
+        write_queue_put_timeout: float = Field(
+            default=0.0,
+            description="Seconds to wait for queue space before dropping (0 drops immediately)",
+        )
+        write_queue_flush_timeout: float = Field(
+            default=30.0, description="Seconds to wait for pending writes on shutdown"
+        )
+
+        # Memory context config
+        context_max_results: int = Field(
+            default=10, description="Maximum memories injected into the prompt (0 for no limit)"
+        )
+        context_min_score: float = Field(
+            default=0.0, description="Minimum relevance score for an injected memory"
+        )
+        context_token_budget: int = Field(
+            default=1000, description="Estimated tokens available for injected memories (0 for no limit)"
+        )
+        context_duplicate_threshold: float = Field(
+            default=0.9, description="Word overlap at which two memories count as duplicates"
+        )
+
+        # Metrics config
+        metrics_path: str = Field(
+            default="",
+            description="File the metrics snapshot is written to, JSON for .json paths and Prometheus text otherwise (empty disables)",
+        )
+        metrics_interval: float = Field(
+            default=15.0, description="Seconds between metrics snapshots"
+        )
         pass
 
     def __init__(self):
         self.type = "filter"
         self.valves = self.Valves(**{"pipelines": ["*"]})
+        self.client = None
+        self.write_queue = None
+        self._client_lock = asyncio.Lock()
+        self.metrics = Metrics()
+        self.metrics.register(
+            "write_queue", lambda: self.write_queue.stats() if self.write_queue else {}
+        )
+        self.metrics_task = None
+        # In-flight requests per client; a replaced client is closed once idle
+        self.borrowed: Dict[int, int] = {}
+        self.retiring: set = set()
         pass
 
+    async def on_valves_updated(self):
+        # Drain writes made with the old key, then rebuild the client lazily
+        await self.close_write_queue()
+        task = asyncio.create_task(self.close_client())
+        self.retiring.add(task)
+        task.add_done_callback(self.retiring.discard)
+        self.start_metrics()
+
     async def on_startup(self):
         print(f"on_startup:{__name__}")
-        pass
+        self.start_metrics()
+        # Validate the key and open the pool before the first user arrives
+        if self.valves.api_key:
+            try:
+                await self.get_client()
+            except Exception as e:
+                print(f"mem0 client init failed, retrying on first request: {str(e)}")
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
-        pass
+        await self.close_write_queue()
+        await self.close_client()
+        if self.retiring:
+            await asyncio.gather(*self.retiring, return_exceptions=True)
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+            self.metrics_task = None
+        self.dump_metrics()
+
+    def start_metrics(self):
+        if self.metrics_task is None and self.valves.metrics_path:
+            self.metrics_task = asyncio.create_task(self._write_metrics())
+
+    async def _write_metrics(self):
+        while self.valves.metrics_path:
+            await asyncio.sleep(self.valves.metrics_interval)
+            await asyncio.to_thread(self.dump_metrics)
+        self.metrics_task = None
+
+    def dump_metrics(self):
+        if self.valves.metrics_path:
+            try:
+                self.metrics.dump(self.valves.metrics_path)
+            except Exception as e:
+                print(f"Failed to write metrics: {str(e)}")
+
+    async def get_client(self) -> AsyncMemoryClient:
+        """Return the shared client, creating it once per valve configuration."""
+        async with self._client_lock:
+            if self.client is None:
+                http_client = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=self.valves.max_connections,
+                        max_keepalive_connections=self.valves.max_keepalive_connections,
+                    ),
+                    timeout=self.valves.request_timeout,
+                )
+                # The constructor validates the key with a blocking request
+                with self.metrics.time("client_init"):
+                    self.client = await asyncio.to_thread(self.build_client, http_client)
+                print("mem0 client initialized")
+        return self.client
+
+    def build_client(self, http_client: httpx.AsyncClient) -> AsyncMemoryClient:
+        """Builds the mem0 client on the pooled connections.
+
+        mem0ai releases without the client parameter build their own httpx
+        client, so the pool is swapped in once the constructor returns.
+        """
+        if "client" in inspect.signature(AsyncMemoryClient.__init__).parameters:
+            return AsyncMemoryClient(api_key=self.valves.api_key, client=http_client)
+        client = AsyncMemoryClient(api_key=self.valves.api_key)
+        # The key check goes through requests, so the default client never connected
+        default, client.async_client = client.async_client, http_client
+        http_client.base_url = default.base_url
+        http_client.headers.update(default.headers)
+        return client
+
+    @asynccontextmanager
+    async def borrow_client(self):
+        """Yields the shared client, counting the use so it is not closed under it."""
+        client = await self.get_client()
+        key = id(client)
+        self.borrowed[key] = self.borrowed.get(key, 0) + 1
+        try:
+            yield client
+        finally:
+            self.borrowed[key] -= 1
+            if not self.borrowed[key]:
+                del self.borrowed[key]
+
+    async def close_client(self):
+        """Detaches the shared client and closes it once its requests finish."""
+        if self.client is not None:
+            # New requests build a fresh client while this one drains
+            client, self.client = self.client, None
+            deadline = time.monotonic() + self.valves.request_timeout
+            while self.borrowed.get(id(client)) and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            await client.async_client.aclose()
+
+    def get_write_queue(self) -> MemoryWriteQueue:
+        if self.write_queue is None:
+            self.write_queue = MemoryWriteQueue(
+                self.add_message_to_mem0,
+                max_pending=self.valves.write_queue_max_pending,
+                workers=self.valves.write_queue_workers,
+                max_batch=self.valves.write_queue_max_batch,
+                put_timeout=self.valves.write_queue_put_timeout,
+            )
+            self.write_queue.start()
+        return self.write_queue
+
+    async def close_write_queue(self):
+        if self.write_queue is not None:
+            queue, self.write_queue = self.write_queue, None
+            await queue.close(self.valves.write_queue_flush_timeout)
+            print(f"Memory write queue closed: {queue.stats()}")
+
+    async def add_message_to_mem0(self, user_id, messages):
+        async with self.borrow_client() as client:
+            with self.metrics.time("memory_add"):
+                await client.add(user_id=user_id, messages=messages)
+        print(f"Added {len(messages)} message(s) to mem0 for user {user_id}")
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         """Inject memory context into the prompt before sending to the model."""
         print("DEBUG: Inlet method triggered")
-        self.client = MemoryClient(api_key=self.valves.api_key)  # Create instance-specific client
 
         print(f"Current module: {__name__}")
         print(f"Request body: {body.keys()}")
@@ -72,56 +569,80 @@ class Pipeline:
         if not user_message:
             return body
 
+        inlet_start = time.perf_counter()
         try:
             # Retrieve relevant memories and update memory with current message
-            print("DEBUG: MemoryClient initialized:", self.client)
-            print("DEBUG: Getting memories...")
-            memories = self.client.search(
-                user_id=current_user_id,
-                query=user_message
-            )
+            async with self.borrow_client() as client:
+                print("DEBUG: MemoryClient initialized:", client)
+                print("DEBUG: Getting memories...")
+                with self.metrics.time("retrieval"):
+                    memories = await client.search(
+                        user_id=current_user_id,
+                        query=user_message
+                    )
             
-            # Add current user message to memory
-            self.client.add(
-                user_id=current_user_id,
-                messages=[{"role": "user", "content": user_message}]
+            # Add current user message to memory off the request path
+            await self.get_write_queue().put(
+                current_user_id, {"role": "user", "content": user_message}
             )
             
             print("DEBUG: Retrieved memories:", memories)
 
-            # Inject memory context into system message
-            if memories:
-                memory_context = "\n\nRelevant memories:\n" + "\n".join(
-                    f"- {mem['memory']}" for mem in memories
-                )
-            else:
-                # Initialize memory for new users
-                try:
-                    self.valves.client.add(
-                        user_id=current_user_id,
-                        messages="System: This is a new user conversation"
-                    )
-                    # Set default context after initialization
-                    memory_context = "\n\nDefault memory initialized for new user conversation"
-                except Exception as e:
-                    print(f"Memory initialization failed: {str(e)}")
-                    memory_context = ""  # Fallback to empty context
-
-            # Find or create system message
-            system_message = next((msg for msg in messages if msg["role"] == "system"), None)
-            if system_message:
-                system_message["content"] += memory_context
-            else:
-                messages.insert(0, {
-                    "role": "system",
-                    "content": f"Use these memories to enhance your response:\n{memory_context}"
-                })
+            with self.metrics.time("prompt_assembly"):
+                # Inject memory context into system message
+                # (a new user has none; their first message is already queued above)
+                memory_context = self.build_context(memories or [])
+
+                # Find or create system message
+                system_message = next((msg for msg in messages if msg["role"] == "system"), None)
+                if not memory_context:
+                    # Nothing relevant enough; leave the prompt untouched
+                    pass
+                elif system_message:
+                    system_message["content"] += memory_context
+                else:
+                    messages.insert(0, {
+                        "role": "system",
+                        "content": f"Use these memories to enhance your response:\n{memory_context}"
+                    })
             
             # Update body with modified messages
             body["messages"] = messages
 
         except Exception as e:
+            self.metrics.inc("inlet_errors")
             print(f"Mem0 integration error: {str(e)}")
 
+        self.metrics.observe("inlet", time.perf_counter() - inlet_start)
+        return body
+
+    async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        """Queue the finished assistant reply for a background write."""
+        messages = body.get("messages", [])
+        reply = next(
+            (m.get("content") for m in reversed(messages) if m.get("role") == "assistant"),
+            None,
+        )
+        if not reply:
+            return body
+
+        user_id = user["id"] if user and "id" in user else self.valves.user_id
+        try:
+            with self.metrics.time("outlet"):
+                await self.get_write_queue().put(
+                    user_id, {"role": "assistant", "content": reply}
+                )
+        except Exception as e:
+            self.metrics.inc("outlet_errors")
+            print(f"Mem0 outlet error: {str(e)}")
         return body
+
+    def build_context(self, results: List[dict]) -> str:
+        builder = ContextBuilder(
+            max_results=self.valves.context_max_results,
+            min_score=self.valves.context_min_score,
+            token_budget=self.valves.context_token_budget,
+            duplicate_threshold=self.valves.context_duplicate_threshold,
+        )
+        return builder.build(results)
     
\ No newline at end of file
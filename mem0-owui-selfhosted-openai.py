@@ -9,11 +9,1281 @@ requirements: mem0ai==0.1.96, pydantic==2.7.4
 """
 
 import os
-from typing import ClassVar, List, Optional
+import bisect
+import functools
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, ClassVar, Dict, List, Optional, Tuple
 from pydantic import BaseModel, Field, model_validator
+from qdrant_client import QdrantClient, models
 from schemas import OpenAIChatMessage
 from mem0 import AsyncMemory
+from mem0.memory.utils import remove_code_blocks
+from mem0.vector_stores.qdrant import Qdrant
 import asyncio
+import httpx
+import numpy as np
+
+
+class IngestionLedger:
+    """Persistent content-hash ledger of messages already sent to mem0.
+
+    Rows are keyed by (user_id, chat_id, digest) so the filters and
+    dev/ingest_memories.py can share one SQLite file. A claim only reserves
+    messages in memory; they are recorded by commit once stored, so a crash
+    or cancelled write never marks unstored messages as ingested.
+    """
+
+    PRUNE_INTERVAL: ClassVar[float] = 3600.0
+
+    def __init__(self, path: str, max_age: float = 0.0):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._reserved: set = set()
+        self._next_prune = 0.0
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ingested ("
+            "user_id TEXT NOT NULL, chat_id TEXT NOT NULL, digest BLOB NOT NULL, "
+            "stored_at REAL NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (user_id, chat_id, digest)) WITHOUT ROWID"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(ingested)")]
+        if "stored_at" not in columns:
+            # Ledgers written before pruning existed start their clock now
+            self._conn.execute(
+                "ALTER TABLE ingested ADD COLUMN stored_at REAL NOT NULL DEFAULT 0"
+            )
+            self._conn.execute("UPDATE ingested SET stored_at = ?", (time.time(),))
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ingested_stored_at ON ingested (stored_at)"
+        )
+        self.prune()
+
+    @staticmethod
+    def digest(message: dict, occurrence: int = 0) -> bytes:
+        content = f"{message.get('role')}\0{message.get('content')}"
+        if occurrence:
+            # Repeats of a message within one chat get keys of their own
+            content += f"\0{occurrence}"
+        return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+    @classmethod
+    def digests(cls, messages: List[dict]) -> List[bytes]:
+        """Digests of a conversation's messages, numbering repeated messages."""
+        seen: Dict[bytes, int] = {}
+        digests = []
+        for message in messages:
+            first = cls.digest(message)
+            digests.append(cls.digest(message, seen.get(first, 0)))
+            seen[first] = seen.get(first, 0) + 1
+        return digests
+
+    @staticmethod
+    def occurrence(messages: List[dict], index: int) -> int:
+        """How often messages[index] already appeared earlier in the conversation."""
+        message = messages[index]
+        return sum(
+            1
+            for earlier in messages[:index]
+            if earlier.get("role") == message.get("role")
+            and earlier.get("content") == message.get("content")
+        )
+
+    @staticmethod
+    def chat_key(chat_id: Optional[str], messages: List[dict]) -> str:
+        """The chat ID, or a hash of the opening message for chats without one."""
+        if chat_id:
+            return chat_id
+        first = next((m for m in messages if m.get("role") != "system"), None)
+        if first is None:
+            return ""
+        opening = f"{first.get('role')}\0{first.get('content')}"
+        return "#" + hashlib.blake2b(opening.encode(), digest_size=8).hexdigest()
+
+    def claim(self, user_id: str, chat_id: str, digests: List[bytes]) -> List[int]:
+        """Reserves digests not stored or reserved yet and returns their positions."""
+        positions = []
+        with self._lock:
+            for i, digest in enumerate(digests):
+                key = (user_id, chat_id, digest)
+                if key in self._reserved:
+                    continue
+                if self._conn.execute(
+                    "SELECT 1 FROM ingested WHERE user_id = ? AND chat_id = ? AND digest = ?",
+                    key,
+                ).fetchone():
+                    continue
+                self._reserved.add(key)
+                positions.append(i)
+        return positions
+
+    def commit(self, user_id: str, chat_id: str, digests: List[bytes]):
+        """Records claimed messages as stored."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ingested VALUES (?, ?, ?, ?)",
+                [(user_id, chat_id, digest, now) for digest in digests],
+            )
+            self._reserved.difference_update(
+                (user_id, chat_id, digest) for digest in digests
+            )
+        if now >= self._next_prune:
+            self.prune()
+
+    def release(self, user_id: str, chat_id: str, digests: List[bytes]):
+        """Drops claims whose write failed so the messages can be ingested again."""
+        with self._lock:
+            self._reserved.difference_update(
+                (user_id, chat_id, digest) for digest in digests
+            )
+
+    def prune(self):
+        """Forgets messages stored more than max_age seconds ago."""
+        self._next_prune = time.time() + self.PRUNE_INTERVAL
+        if self.max_age > 0:
+            with self._lock:
+                self._conn.execute(
+                    "DELETE FROM ingested WHERE stored_at < ?",
+                    (time.time() - self.max_age,),
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbedder:
+    """Memoizes a mem0 embedder's vectors by (model, text hash).
+
+    Wraps the configured embedder with an in-process LRU tier and an optional
+    SQLite tier that survives restarts and can be shared with the ingest script.
+    """
+
+    def __init__(self, embedder, max_entries: int = 10000, path: str = ""):
+        self.embedder = embedder
+        self.model = getattr(embedder.config, "model", None) or type(embedder).__name__
+        self.max_entries = max(1, max_entries)
+        self._lru: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, digest BLOB NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, digest)) WITHOUT ROWID"
+            )
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # Expose config and any provider specific attributes of the wrapped embedder
+        return getattr(self.embedder, name)
+
+    def embed(self, text, memory_action=None):
+        digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        with self._lock:
+            vector = self._lru.get(digest)
+            if vector is not None:
+                self._lru.move_to_end(digest)
+                self.hits += 1
+                return vector
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT vector FROM embeddings WHERE model = ? AND digest = ?",
+                    (self.model, digest),
+                ).fetchone()
+                if row is not None:
+                    vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    self.disk_hits += 1
+                    self._remember(digest, vector)
+                    return vector
+
+        vector = self.embedder.embed(text, memory_action)
+        with self._lock:
+            self.misses += 1
+            self._remember(digest, vector)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (self.model, digest, np.asarray(vector, dtype=np.float32).tobytes()),
+                )
+        return vector
+
+    def _remember(self, digest: bytes, vector: List[float]):
+        self._lru[digest] = vector
+        self._lru.move_to_end(digest)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._lru),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class SearchCache:
+    """Per-user LRU/TTL cache of search results.
+
+    A query reuses cached results when it matches a recent query exactly or
+    when the cosine similarity of the query embeddings reaches threshold.
+    Results prefetched for a user's next turn are kept apart and handed to
+    that turn once, whatever its query.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 32,
+        max_users: int = 1000,
+        ttl: float = 300.0,
+        threshold: float = 0.95,
+        embed_first: bool = False,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.max_users = max(1, max_users)
+        self.ttl = ttl
+        self.threshold = threshold
+        # Embed every query, not just those with entries to compare against.
+        # Only worthwhile when the embedder is memoized and search reuses the vector.
+        self.embed_first = embed_first
+        # user_id -> normalized query -> (unit vector or None, results, stored_at)
+        self._users: "OrderedDict[str, OrderedDict[str, tuple]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        # user_id -> (results, generation, stored_at) prefetched for the next turn
+        self._next: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.prefetch_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def _entries(self, user_id: str) -> Optional["OrderedDict[str, tuple]"]:
+        entries = self._users.get(user_id)
+        if entries is None:
+            return None
+        cutoff = time.monotonic() - self.ttl
+        for key in [k for k, (_, _, stored_at) in entries.items() if stored_at < cutoff]:
+            del entries[key]
+            self.evictions += 1
+        if not entries:
+            del self._users[user_id]
+            return None
+        self._users.move_to_end(user_id)
+        return entries
+
+    def _similar(self, entries, vector: np.ndarray) -> Optional[str]:
+        best_key, best_score = None, self.threshold
+        for key, (cached_vector, _, _) in entries.items():
+            if cached_vector is not None:
+                score = float(np.dot(cached_vector, vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+        return best_key
+
+    async def fetch(
+        self,
+        user_id: str,
+        query: str,
+        search: Callable[[], Awaitable[Any]],
+        embed: Optional[Callable[[str], Awaitable[List[float]]]] = None,
+    ):
+        """Return cached results for query, or run search and cache its results."""
+        key = self.normalize(query)
+        entries = self._entries(user_id)
+        if entries is not None and key in entries:
+            entries.move_to_end(key)
+            self.hits += 1
+            return entries[key][1]
+
+        vector = None
+        if embed is not None and self.threshold < 1 and (entries or self.embed_first):
+            vector = self._unit(await embed(query))
+            similar_key = self._similar(entries, vector) if entries else None
+            if similar_key is not None:
+                entries.move_to_end(similar_key)
+                self.semantic_hits += 1
+                return entries[similar_key][1]
+
+        self.misses += 1
+        generation = self._generations.get(user_id, 0)
+        results = await search()
+        # Drop results that raced with a write for this user
+        if self._generations.get(user_id, 0) == generation:
+            self.put(user_id, key, results, vector)
+        return results
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def put(self, user_id: str, key: str, results, vector: Optional[np.ndarray]):
+        entries = self._users.setdefault(user_id, OrderedDict())
+        entries[key] = (vector, results, time.monotonic())
+        entries.move_to_end(key)
+        self._users.move_to_end(user_id)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+        while len(self._users) > self.max_users:
+            _, evicted = self._users.popitem(last=False)
+            self.evictions += len(evicted)
+
+    def generation(self, user_id: str) -> int:
+        """Bumped by every invalidation of the user's results."""
+        return self._generations.get(user_id, 0)
+
+    def put_next(self, user_id: str, results, generation: int):
+        """Keeps prefetched results for the user's next turn unless a write raced them."""
+        if self.generation(user_id) != generation:
+            return
+        self._next[user_id] = (results, generation, time.monotonic())
+        self._next.move_to_end(user_id)
+        while len(self._next) > self.max_users:
+            self._next.popitem(last=False)
+
+    def take_next(self, user_id: str):
+        """Returns and forgets the user's prefetched results if still current."""
+        entry = self._next.pop(user_id, None)
+        if entry is None:
+            return None
+        results, generation, stored_at = entry
+        if generation != self.generation(user_id) or stored_at < time.monotonic() - self.ttl:
+            return None
+        self.prefetch_hits += 1
+        return results
+
+    def invalidate(self, user_id: str):
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+        if self._users.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "users": len(self._users),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "prefetch_hits": self.prefetch_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class MemoryWriteQueue:
+    """Bounded write-behind queue that coalesces pending messages per user.
+
+    Messages for the same user are grouped into a single write and a user is
+    never written by two workers at once, so memory updates stay ordered.
+    """
+
+    def __init__(
+        self,
+        writer: Callable[[str, List[Any]], Awaitable[None]],
+        max_pending: int = 1000,
+        workers: int = 2,
+        max_batch: int = 20,
+        put_timeout: float = 0.0,
+    ):
+        self.writer = writer
+        self.max_pending = max(1, max_pending)
+        self.worker_count = max(1, workers)
+        self.max_batch = max(1, max_batch)
+        self.put_timeout = put_timeout
+        self._pending: Dict[str, List[Any]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._active: set = set()
+        self._space = asyncio.Condition()
+        self._workers: List[asyncio.Task] = []
+        self.size = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+    def start(self):
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._run()) for _ in range(self.worker_count)
+            ]
+
+    async def put(self, user_id: str, item: Any) -> bool:
+        """Queue an item, waiting up to put_timeout for space. Returns False if dropped."""
+        if self.size >= self.max_pending and self.put_timeout > 0:
+            async with self._space:
+                try:
+                    await asyncio.wait_for(
+                        self._space.wait_for(lambda: self.size < self.max_pending),
+                        self.put_timeout,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        if self.size >= self.max_pending:
+            self.dropped += 1
+            print(f"Memory write queue full, dropped message for user {user_id}")
+            return False
+
+        batch = self._pending.setdefault(user_id, [])
+        batch.append(item)
+        self.size += 1
+        self.enqueued += 1
+        # A user already waiting or being written is re-queued by its worker.
+        if len(batch) == 1 and user_id not in self._active:
+            self._ready.put_nowait(user_id)
+        return True
+
+    async def _run(self):
+        while True:
+            user_id = await self._ready.get()
+            self._active.add(user_id)
+            items = self._pending.pop(user_id, [])
+            batch, rest = items[: self.max_batch], items[self.max_batch :]
+            if rest:
+                self._pending[user_id] = rest
+            self.size -= len(batch)
+            try:
+                await self.writer(user_id, batch)
+                self.written += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"Memory write failed for user {user_id}: {str(e)}")
+            finally:
+                self._active.discard(user_id)
+                if user_id in self._pending:
+                    self._ready.put_nowait(user_id)
+                self._ready.task_done()
+                async with self._space:
+                    self._space.notify_all()
+
+    async def close(self, timeout: Optional[float] = None):
+        """Flush pending writes (bounded by timeout) and stop the workers."""
+        if self._workers:
+            try:
+                await asyncio.wait_for(self._ready.join(), timeout)
+            except asyncio.TimeoutError:
+                print(f"Memory write queue flush timed out, {self.size} messages lost")
+            for task in self._workers:
+                task.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            self._workers = []
+
+    @property
+    def idle(self) -> bool:
+        return self.size == 0 and not self._active
+
+    def has_pending(self, user_id: str) -> bool:
+        """Whether a write for the user is waiting to be picked up."""
+        return user_id in self._pending
+
+    def busy(self, user_id: str) -> bool:
+        """Whether a write for the user is waiting or in progress."""
+        return user_id in self._pending or user_id in self._active
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit is open."""
+
+
+class CircuitBreaker:
+    """Per-dependency circuit breaker shared by mem0's worker threads.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    fail fast with CircuitOpenError. Once reset_timeout has passed, up to
+    half_open_probes calls are let through; a success closes the circuit and
+    a failure opens it again.
+    """
+
+    # Seconds callers wait for an in-flight probe before trying again
+    PROBE_WAIT: ClassVar[float] = 0.5
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        half_open_probes: int = 1,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = max(1, half_open_probes)
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def retry_in(self) -> float:
+        """Seconds until a call would be let through (0 if it would be now)."""
+        with self._lock:
+            if self.state == "closed":
+                return 0.0
+            if self.state == "open":
+                return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+            return 0.0 if self.probes < self.half_open_probes else self.PROBE_WAIT
+
+    def _allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() < self.opened_at + self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = "half_open"
+                self.probes = 0
+            if self.probes >= self.half_open_probes:
+                self.rejected += 1
+                return False
+            self.probes += 1
+            return True
+
+    def _record(self, ok: bool):
+        with self._lock:
+            if self.state == "half_open":
+                self.probes -= 1
+            if ok:
+                if self.state != "closed":
+                    print(f"Circuit for {self.name} closed")
+                self.state = "closed"
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or (
+                self.state == "closed" and self.failures >= self.failure_threshold
+            ):
+                if self.state == "closed":
+                    print(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.opened += 1
+
+    def call(self, fn: Callable, *args, **kwargs):
+        if not self._allow():
+            raise CircuitOpenError(f"{self.name} is unavailable (circuit open)")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True)
+        return result
+
+    async def acall(self, fn: Callable[..., Awaitable], *args, **kwargs):
+        """Like call, for coroutine functions."""
+        if not self._allow():
+            raise CircuitOpenError(f"{self.name} is unavailable (circuit open)")
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            # Not the dependency's fault; just free the probe slot
+            with self._lock:
+                if self.state == "half_open":
+                    self.probes -= 1
+            raise
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True)
+        return result
+
+    def guard(self, obj, method: str):
+        """Replace obj.method with a version that goes through the breaker."""
+        original = getattr(obj, method)
+
+        @functools.wraps(original)
+        def guarded(*args, **kwargs):
+            return self.call(original, *args, **kwargs)
+
+        setattr(obj, method, guarded)
+
+    def stats(self) -> dict:
+        return {
+            "open": int(self.state != "closed"),
+            "failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+class LockedQdrantLocal:
+    """Serializes calls into Qdrant's local mode, which is not thread-safe.
+
+    mem0 reaches the vector store from worker threads, and concurrent
+    upserts corrupt the local segments.
+    """
+
+    def __init__(self, local):
+        self._local = local
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._local, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class ShardedVectorStore:
+    """Routes mem0 vector store calls to one of several collections by user.
+
+    Each user's memories live in the collection picked by a stable hash of
+    the user ID, so a search only scans that user's shard. Calls made by
+    memory ID alone find the shard through a bounded ID map, falling back to
+    asking each shard in turn.
+    """
+
+    def __init__(self, shards: List[Any], max_ids: int = 100000):
+        self.shards = shards
+        self.max_ids = max_ids
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.shards[0], name)
+
+    @staticmethod
+    def shard_index(user_id: str, count: int) -> int:
+        digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % count
+
+    def _user_shard(self, values: Optional[dict]) -> Optional[int]:
+        if values and values.get("user_id") is not None:
+            return self.shard_index(values["user_id"], len(self.shards))
+        return None
+
+    def _remember(self, vector_id, index: int):
+        with self._lock:
+            self._ids[str(vector_id)] = index
+            self._ids.move_to_end(str(vector_id))
+            while len(self._ids) > self.max_ids:
+                self._ids.popitem(last=False)
+
+    def _find(self, vector_id) -> Optional[Tuple[int, Any]]:
+        with self._lock:
+            index = self._ids.get(str(vector_id))
+        candidates = range(len(self.shards)) if index is None else [index]
+        for i in candidates:
+            record = self.shards[i].get(vector_id=vector_id)
+            if record is not None:
+                self._remember(vector_id, i)
+                return i, record
+        return None
+
+    def insert(self, vectors: list, payloads: list = None, ids: list = None):
+        groups: Dict[int, List[int]] = {}
+        for position in range(len(vectors)):
+            index = self._user_shard(payloads[position] if payloads else None)
+            groups.setdefault(0 if index is None else index, []).append(position)
+        for index, positions in groups.items():
+            shard_ids = [ids[p] for p in positions] if ids else None
+            self.shards[index].insert(
+                vectors=[vectors[p] for p in positions],
+                payloads=[payloads[p] for p in positions] if payloads else None,
+                ids=shard_ids,
+            )
+            for vector_id in shard_ids or []:
+                self._remember(vector_id, index)
+
+    def search(self, query: str, vectors: list, limit: int = 5, filters: dict = None):
+        index = self._user_shard(filters)
+        if index is not None:
+            hits = self.shards[index].search(
+                query=query, vectors=vectors, limit=limit, filters=filters
+            )
+            for hit in hits:
+                self._remember(hit.id, index)
+            return hits
+        hits = [
+            hit
+            for shard in self.shards
+            for hit in shard.search(query=query, vectors=vectors, limit=limit, filters=filters)
+        ]
+        return sorted(hits, key=lambda hit: hit.score, reverse=True)[:limit]
+
+    def get(self, vector_id):
+        found = self._find(vector_id)
+        return found[1] if found else None
+
+    def update(self, vector_id, vector: list = None, payload: dict = None):
+        index = self._user_shard(payload)
+        if index is None:
+            found = self._find(vector_id)
+            index = found[0] if found else 0
+        self.shards[index].update(vector_id=vector_id, vector=vector, payload=payload)
+
+    def delete(self, vector_id):
+        found = self._find(vector_id)
+        if found is not None:
+            self.shards[found[0]].delete(vector_id=vector_id)
+            with self._lock:
+                self._ids.pop(str(vector_id), None)
+
+    def list(self, filters: dict = None, limit: int = 100):
+        index = self._user_shard(filters)
+        if index is not None:
+            return self.shards[index].list(filters=filters, limit=limit)
+        points = [
+            point
+            for shard in self.shards
+            for point in shard.list(filters=filters, limit=limit)[0]
+        ]
+        return points[:limit], None
+
+    def delete_col(self):
+        for shard in self.shards:
+            shard.delete_col()
+
+    def reset(self):
+        for shard in self.shards:
+            shard.reset()
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart (a rate of 0 disables it)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+
+class MemoryCompactor:
+    """Merges or deletes a user's near-duplicate memories.
+
+    Memories are clustered greedily, oldest first: each joins the cluster
+    whose first member it is most similar to, if that similarity reaches
+    threshold. With use_llm the LLM rewrites each cluster into one memory,
+    stored over the newest member; without it the newest member is kept as
+    is. The other members are deleted through mem0, so history is recorded.
+    Vector store and embedder calls share io_rate, LLM calls use llm_rate.
+    """
+
+    MERGE_PROMPT: ClassVar[str] = (
+        "The memories below are about the same user and say nearly the same "
+        "thing. They are listed oldest first. Merge them into one concise "
+        "memory that keeps every distinct fact; where they disagree, keep the "
+        'newest. Reply in JSON as {"memory": "<merged memory>"}.\n\n'
+    )
+
+    def __init__(
+        self,
+        threshold: float = 0.92,
+        use_llm: bool = True,
+        io_rate: float = 5.0,
+        llm_rate: float = 0.2,
+        max_memories: int = 2000,
+        dry_run: bool = False,
+        idle: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.threshold = threshold
+        self.use_llm = use_llm
+        self.max_memories = max_memories
+        self.dry_run = dry_run
+        self.idle = idle
+        self.io = RateLimiter(io_rate)
+        self.llm = RateLimiter(llm_rate)
+
+    @staticmethod
+    def stores(memory) -> List:
+        return getattr(memory.vector_store, "shards", None) or [memory.vector_store]
+
+    def user_store(self, memory, user_id: str):
+        stores = self.stores(memory)
+        return stores[ShardedVectorStore.shard_index(user_id, len(stores))]
+
+    async def users(self, memory) -> List[str]:
+        """Every user ID with stored memories."""
+        seen = set()
+        for store in self.stores(memory):
+            offset = None
+            while True:
+                await self.io.wait()
+                page, offset = await asyncio.to_thread(
+                    store.client.scroll,
+                    collection_name=store.collection_name,
+                    limit=1024,
+                    offset=offset,
+                    with_payload=["user_id"],
+                    with_vectors=False,
+                )
+                seen.update(p.payload["user_id"] for p in page if p.payload.get("user_id"))
+                if offset is None:
+                    break
+        return sorted(seen)
+
+    async def load(self, memory, user_id: str) -> List:
+        store = self.user_store(memory, user_id)
+        condition = models.Filter(
+            must=[models.FieldCondition(key="user_id", match=models.MatchValue(value=user_id))]
+        )
+        points, offset = [], None
+        while len(points) < self.max_memories:
+            await self.io.wait()
+            page, offset = await asyncio.to_thread(
+                store.client.scroll,
+                collection_name=store.collection_name,
+                scroll_filter=condition,
+                limit=min(256, self.max_memories - len(points)),
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            points.extend(p for p in page if p.vector and p.payload.get("data"))
+            if offset is None:
+                break
+        return points
+
+    def cluster(self, vectors: np.ndarray) -> List[List[int]]:
+        unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        leaders: List[int] = []
+        clusters: List[List[int]] = []
+        for i in range(len(unit)):
+            if leaders:
+                scores = unit[leaders] @ unit[i]
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    clusters[best].append(i)
+                    continue
+            leaders.append(i)
+            clusters.append([i])
+        return [members for members in clusters if len(members) > 1]
+
+    async def merge(self, memory, texts: List[str]) -> Optional[str]:
+        await self.llm.wait()
+        prompt = self.MERGE_PROMPT + "\n".join(f"- {text}" for text in texts)
+        try:
+            response = await asyncio.to_thread(
+                memory.llm.generate_response,
+                messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"},
+            )
+            merged = json.loads(remove_code_blocks(response))["memory"]
+        except Exception as e:
+            print(f"Could not merge {len(texts)} memories: {str(e)}")
+            return None
+        return merged.strip() if isinstance(merged, str) and merged.strip() else None
+
+    async def compact_user(self, memory, user_id: str) -> Dict[str, int]:
+        """Compacts one user's memories and returns what was scanned and removed."""
+        points = await self.load(memory, user_id)
+        points.sort(key=lambda p: p.payload.get("updated_at") or p.payload.get("created_at") or "")
+        report = {"scanned": len(points), "clusters": 0, "merged": 0, "removed": 0}
+        if len(points) < 2:
+            return report
+        clusters = self.cluster(np.asarray([p.vector for p in points], dtype=np.float32))
+        report["clusters"] = len(clusters)
+        for members in clusters:
+            group = [points[i] for i in members]
+            keep, redundant = group[-1], group[:-1]
+            if self.dry_run:
+                report["removed"] += len(redundant)
+                continue
+            text = keep.payload["data"]
+            if self.use_llm:
+                text = await self.merge(memory, [p.payload["data"] for p in group])
+                if text is None:
+                    continue
+            if self.idle is not None:
+                await self.idle()
+            if text != keep.payload["data"]:
+                await self.io.wait()
+                await memory.update(keep.id, text)
+                report["merged"] += 1
+            for point in redundant:
+                await self.io.wait()
+                await memory.delete(point.id)
+                report["removed"] += 1
+        return report
+
+
+class MessageGate:
+    """Cheap local check for messages unlikely to hold memorable facts.
+
+    Messages matching the skip pattern (bare acknowledgements) are dropped.
+    Messages that are very short, mostly stopwords or, with the scorer on,
+    score too low are deferred: the caller holds them and writes them with
+    the user's next message, so they cost no extraction call of their own.
+    """
+
+    STOPWORDS: ClassVar[frozenset] = frozenset(
+        "a an and are as at be but by can do does for from had has have he her "
+        "him his how i if in is it its just me my no not of oh ok okay on or "
+        "please so sure that the then there they this to too us was we well "
+        "what when which who why will with yeah yes you your".split()
+    )
+    FACT_HINTS: ClassVar[frozenset] = frozenset(
+        "i i'm im my me mine we our am live lives work works like love prefer "
+        "hate have born name allergic favorite favourite want need plan always "
+        "never usually".split()
+    )
+
+    def __init__(
+        self,
+        min_chars: int = 8,
+        max_stopword_ratio: float = 0.9,
+        skip_pattern: str = "",
+        min_score: float = 0.0,
+        defer: bool = True,
+    ):
+        self.min_chars = min_chars
+        self.max_stopword_ratio = max_stopword_ratio
+        self.min_score = min_score
+        self.defer = defer
+        self.skip_pattern = None
+        if skip_pattern:
+            try:
+                self.skip_pattern = re.compile(skip_pattern)
+            except re.error as e:
+                print(f"Ignoring invalid gate skip pattern: {str(e)}")
+        self.passed = 0
+        self.skipped = 0
+        self.deferred = 0
+        self.reasons: Dict[str, int] = {}
+
+    def score(self, text: str, words: List[str]) -> float:
+        """Rough likelihood that text states a fact about the user."""
+        score = float(min(3, sum(w in self.FACT_HINTS for w in words)))
+        if any(c.isdigit() for c in text):
+            score += 1.0
+        # Capitalized words after the first are likely names and places
+        if any(w[:1].isupper() for w in text.split()[1:]):
+            score += 1.0
+        return score + min(len(words) / 20, 1.0)
+
+    def classify(self, text: str) -> str:
+        """Returns "pass", "defer" or "skip" for a message's content."""
+        stripped = text.strip()
+        words = re.findall(r"[\w']+", stripped.lower())
+        if self.skip_pattern is not None and self.skip_pattern.search(stripped):
+            reason = "pattern"
+        elif len(stripped) < self.min_chars:
+            reason = "short"
+        elif words and (
+            sum(w in self.STOPWORDS for w in words) / len(words)
+            > self.max_stopword_ratio
+        ):
+            reason = "stopwords"
+        elif self.min_score > 0 and self.score(stripped, words) < self.min_score:
+            reason = "score"
+        else:
+            self.passed += 1
+            return "pass"
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        if self.defer and reason != "pattern":
+            self.deferred += 1
+            return "defer"
+        self.skipped += 1
+        return "skip"
+
+    def stats(self) -> dict:
+        return {
+            "passed": self.passed,
+            "skipped": self.skipped,
+            "deferred": self.deferred,
+            **{f"reason_{k}": v for k, v in self.reasons.items()},
+        }
+
+
+class ContextBuilder:
+    """Packs the most relevant memories into a bounded prompt section.
+
+    Results are ranked by score, filtered by min_score and de-duplicated by
+    word overlap, then added while they fit max_results and the token budget.
+    Tokens are estimated locally at about four characters each.
+    """
+
+    def __init__(
+        self,
+        max_results: int = 10,
+        min_score: float = 0.0,
+        token_budget: int = 1000,
+        duplicate_threshold: float = 0.9,
+    ):
+        self.max_results = max_results
+        self.min_score = min_score
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        return len(text) // 4 + 1
+
+    @staticmethod
+    def words(text: str) -> frozenset:
+        return frozenset(
+            "".join(c if c.isalnum() else " " for c in text.lower()).split()
+        )
+
+    def is_duplicate(self, words: frozenset, kept: List[frozenset]) -> bool:
+        for other in kept:
+            union = len(words | other)
+            if not union or len(words & other) / union >= self.duplicate_threshold:
+                return True
+        return False
+
+    def select(self, results: List[dict]) -> List[str]:
+        """Returns the memory texts to inject, best first."""
+        ranked = sorted(
+            (r for r in results if r.get("memory")),
+            key=lambda r: r.get("score") or 0.0,
+            reverse=True,
+        )
+        selected: List[str] = []
+        kept: List[frozenset] = []
+        used = 0
+        for result in ranked:
+            if self.max_results and len(selected) >= self.max_results:
+                break
+            if (result.get("score") or 0.0) < self.min_score:
+                break
+            words = self.words(result["memory"])
+            if self.is_duplicate(words, kept):
+                continue
+            cost = self.estimate_tokens(result["memory"]) + 2
+            # Skip what does not fit; a shorter, lower ranked memory may still
+            if self.token_budget and used + cost > self.token_budget:
+                continue
+            selected.append(result["memory"])
+            kept.append(words)
+            used += cost
+        return selected
+
+    def build(self, results: List[dict]) -> str:
+        selected = self.select(results)
+        if not selected:
+            return ""
+        return "\n\nRelevant memories:\n" + "\n".join(f"- {m}" for m in selected)
+
+
+class BackendFailures:
+    """Records backend errors raised while a memory add is in progress.
+
+    mem0 logs and swallows failures of the update LLM call and of the vector
+    store writes, so add returns normally even when nothing was stored.
+    Tracked methods note their errors for the add collecting in the current
+    context (mem0's worker threads inherit it), and the caller checks them
+    once add returns.
+    """
+
+    _current: ClassVar[ContextVar] = ContextVar("backend_failures", default=None)
+
+    @classmethod
+    @contextmanager
+    def collect(cls):
+        """Yields the list of errors raised by tracked methods in this block."""
+        failures: List[Exception] = []
+        token = cls._current.set(failures)
+        try:
+            yield failures
+        finally:
+            cls._current.reset(token)
+
+    @classmethod
+    def track(cls, obj, method: str):
+        """Replace obj.method with a version that records its errors."""
+        original = getattr(obj, method)
+
+        @functools.wraps(original)
+        def tracked(*args, **kwargs):
+            try:
+                return original(*args, **kwargs)
+            except Exception as e:
+                failures = cls._current.get()
+                if failures is not None:
+                    failures.append(e)
+                raise
+
+        setattr(obj, method, tracked)
+
+
+class Metrics:
+    """Thread-safe counters and per-stage latency histograms.
+
+    Recording is a bisect and a few dict updates under a lock. Stats
+    providers are only evaluated when a snapshot is taken, so queue and
+    cache figures cost nothing on the hot path.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, prefix: str = "mem0_owui"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        # stage -> [per-bucket counts (last is +Inf), sum, count]
+        self._stages: Dict[str, list] = {}
+        self._providers: Dict[str, Callable[[], dict]] = {}
+
+    def inc(self, event: str, amount: float = 1):
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + amount
+
+    def observe(self, stage: str, seconds: float):
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, stage: str):
+        """Time the enclosed block as stage, counting stage_errors on exceptions."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f"{stage}_errors")
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def instrument(self, obj, method: str, stage: str):
+        """Replace obj.method with a version timed as stage."""
+        original = getattr(obj, method)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            with self.time(stage):
+                return original(*args, **kwargs)
+
+        setattr(obj, method, timed)
+
+    def register(self, name: str, provider: Callable[[], dict]):
+        """Register a callable returning numeric stats, read at snapshot time."""
+        self._providers[name] = provider
+
+    def _quantile(self, counts: List[int], total: int, q: float) -> float:
+        # Upper bound of the bucket holding the quantile
+        rank, seen = q * total, 0
+        for bound, count in zip(self.BUCKETS, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            stages = {k: (list(v[0]), v[1], v[2]) for k, v in self._stages.items()}
+        gauges = {}
+        for name, provider in self._providers.items():
+            try:
+                for key, value in (provider() or {}).items():
+                    gauges[f"{name}_{key}"] = value
+            except Exception as e:
+                print(f"Metrics provider {name} failed: {str(e)}")
+        return {
+            "counters": counters,
+            "gauges": gauges,
+            "stages": {
+                stage: {
+                    "count": count,
+                    "sum": total,
+                    "mean": total / count if count else 0.0,
+                    "p50": self._quantile(counts, count, 0.50),
+                    "p95": self._quantile(counts, count, 0.95),
+                    "p99": self._quantile(counts, count, 0.99),
+                    "buckets": counts,
+                }
+                for stage, (counts, total, count) in stages.items()
+            },
+        }
+
+    def render_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        p = self.prefix
+        lines = [f"# TYPE {p}_events_total counter"]
+        for event, value in sorted(snapshot["counters"].items()):
+            lines.append(f'{p}_events_total{{event="{event}"}} {value}')
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {float(value)}")
+        lines.append(f"# TYPE {p}_stage_seconds histogram")
+        for stage, data in sorted(snapshot["stages"].items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), data["buckets"]):
+                cumulative += count
+                lines.append(
+                    f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {data["sum"]}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {data["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """Atomically write a snapshot, as JSON for .json paths and Prometheus text otherwise."""
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.render_prometheus()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
 
 
 class Pipeline:
@@ -31,10 +1301,56 @@ class Pipeline:
         qdrant_port: str = Field(
             default="6333", description="Qdrant vector database port"
         )
+        qdrant_path: str = Field(
+            default="", description="Run Qdrant inside the pipelines process with its data in this directory (':memory:' keeps it in RAM); overrides qdrant_host/qdrant_port"
+        )
         collection_name: str = Field(
             default="mem1536", description="Qdrant collection name for 1536-dimensional vectors"
         )
 
+        # Tenancy config
+        qdrant_user_index: bool = Field(
+            default=True, description="Create a keyword payload index on user_id at startup"
+        )
+        collection_shards: int = Field(
+            default=1, description="Spread users over this many collections by a hash of their ID (1 keeps one collection)"
+        )
+
+        # Index config
+        quantization: str = Field(
+            default="none", description="Vector quantization: none, scalar (int8) or binary"
+        )
+        quantization_always_ram: bool = Field(
+            default=True, description="Keep quantized vectors in RAM when the originals are on disk"
+        )
+        quantization_rescore: bool = Field(
+            default=True, description="Rescore quantized candidates with the original vectors"
+        )
+        quantization_oversampling: float = Field(
+            default=2.0, description="Quantized candidates fetched per requested result before rescoring"
+        )
+        hnsw_m: int = Field(default=16, description="HNSW links per node")
+        hnsw_ef_construct: int = Field(
+            default=100, description="HNSW candidate list size while building the index"
+        )
+        hnsw_ef: int = Field(
+            default=0, description="HNSW candidate list size at search time (0 uses ef_construct)"
+        )
+
+        # Graph memory config
+        graph_enabled: bool = Field(
+            default=False, description="Also store and search entity relations in Neo4j (needs langchain-neo4j and rank-bm25)"
+        )
+        neo4j_url: str = Field(default="bolt://neo4j:7687", description="Neo4j connection URL")
+        neo4j_username: str = Field(default="neo4j", description="Neo4j username")
+        neo4j_password: str = Field(default="", description="Neo4j password")
+        graph_search_timeout: float = Field(
+            default=2.0, description="Seconds inlet waits for graph relations before going ahead without them (0 waits indefinitely)"
+        )
+        graph_relation_score: float = Field(
+            default=0.5, description="Score graph relations are ranked with against vector memories"
+        )
+
         # LLM config
         llm_provider: str = Field(
             default="openai", description="LLM provider (openai, etc)"
@@ -58,39 +1374,792 @@ class Pipeline:
             default="text-embedding-3-small", description="Embedding model name"
         )
 
+        # Write queue config
+        write_queue_max_pending: int = Field(
+            default=1000, description="Maximum messages waiting to be written to mem0"
+        )
+        write_queue_workers: int = Field(
+            default=2, description="Number of background mem0 writers"
+        )
+        write_queue_max_batch: int = Field(
+            default=20, description="Maximum messages per user coalesced into one add"
+        )
+        write_queue_put_timeout: float = Field(
+            default=0.0,
+            description="Seconds to wait for queue space before dropping (0 drops immediately)",
+        )
+        write_queue_flush_timeout: float = Field(
+            default=30.0, description="Seconds to wait for pending writes on shutdown"
+        )
+
+        # Circuit breaker config
+        breaker_failure_threshold: int = Field(
+            default=5, description="Consecutive failures that open a dependency's circuit (0 disables the breakers)"
+        )
+        breaker_reset_timeout: float = Field(
+            default=30.0, description="Seconds an open circuit fails fast before probing the dependency again"
+        )
+        breaker_half_open_probes: int = Field(
+            default=1, description="Calls let through to probe a dependency whose circuit is half-open"
+        )
+
+        # Ingestion ledger config
+        ledger_path: str = Field(
+            default=os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "mem0_ledger.db"
+            ),
+            description="SQLite ledger of already ingested messages (empty to disable)",
+        )
+        ledger_max_age_days: float = Field(
+            default=90.0, description="Days a stored message stays in the ledger (0 keeps it forever)"
+        )
+
+        # Search cache config
+        search_cache_size: int = Field(
+            default=32, description="Cached searches per user (0 disables the cache)"
+        )
+        search_cache_max_users: int = Field(
+            default=1000, description="Maximum users held in the search cache"
+        )
+        search_cache_ttl: float = Field(
+            default=300.0, description="Seconds a cached search stays valid"
+        )
+        search_cache_threshold: float = Field(
+            default=0.95,
+            description="Query embedding similarity needed to reuse a cached search (1 for exact matches only)",
+        )
+
+        # Retrieval deadline config
+        search_timeout: float = Field(
+            default=3.0,
+            description="Seconds inlet waits for memory search before falling back to the last known memories (0 waits indefinitely)",
+        )
+
+        # Memory context config
+        context_max_results: int = Field(
+            default=10, description="Maximum memories injected into the prompt (0 for no limit)"
+        )
+        context_min_score: float = Field(
+            default=0.0, description="Minimum relevance score for an injected memory"
+        )
+        context_token_budget: int = Field(
+            default=1000, description="Estimated tokens available for injected memories (0 for no limit)"
+        )
+        context_duplicate_threshold: float = Field(
+            default=0.9, description="Word overlap at which two memories count as duplicates"
+        )
+
+        # Message gate config
+        gate_enabled: bool = Field(
+            default=True, description="Hold back low-information messages before the write path"
+        )
+        gate_min_chars: int = Field(
+            default=8, description="Messages shorter than this are deferred"
+        )
+        gate_max_stopword_ratio: float = Field(
+            default=0.9, description="Messages with a larger share of stopwords are deferred"
+        )
+        gate_skip_pattern: str = Field(
+            default=r"(?i)^\W*(thanks?( you)?( so much| a lot)?|thx|ty|ok(ay)?|k|cool|great|nice|got it|lol|continue|go on)\W*$",
+            description="Regex for messages that are dropped outright",
+        )
+        gate_min_score: float = Field(
+            default=0.0, description="Minimum heuristic fact score, from 0 to 6 (0 disables the scorer)"
+        )
+        gate_defer_limit: int = Field(
+            default=4, description="Deferred messages per user before they are written together (0 drops them instead)"
+        )
+
+        # Prefetch config
+        prefetch_enabled: bool = Field(
+            default=True, description="Store replies and prefetch next-turn memories from outlet"
+        )
+        prefetch_query_chars: int = Field(
+            default=1000, description="Characters from the end of the reply used as the prefetch query"
+        )
+
+        # Compaction config
+        compaction_enabled: bool = Field(
+            default=False, description="Merge near-duplicate memories of recently written users in the background"
+        )
+        compaction_interval: float = Field(
+            default=3600.0, description="Seconds between background compaction passes"
+        )
+        compaction_threshold: float = Field(
+            default=0.92, description="Cosine similarity at which two memories count as redundant"
+        )
+        compaction_use_llm: bool = Field(
+            default=True, description="Merge redundant memories with the LLM (otherwise keep the newest as is)"
+        )
+        compaction_io_rate: float = Field(
+            default=5.0, description="Vector store and embedder calls per second made by compaction"
+        )
+        compaction_llm_rate: float = Field(
+            default=0.2, description="LLM calls per second made by compaction"
+        )
+        compaction_max_memories: int = Field(
+            default=2000, description="Most memories per user considered in one compaction pass"
+        )
+
+        # Metrics config
+        metrics_path: str = Field(
+            default="",
+            description="File the metrics snapshot is written to, JSON for .json paths and Prometheus text otherwise (empty disables)",
+        )
+        metrics_interval: float = Field(
+            default=15.0, description="Seconds between metrics snapshots"
+        )
+
+        # Connection pool config
+        max_connections: int = Field(
+            default=100, description="Maximum open connections per pool (LLM and embedder share one, Qdrant has its own)"
+        )
+        max_keepalive_connections: int = Field(
+            default=20, description="Idle connections kept alive for reuse"
+        )
+        keepalive_expiry: float = Field(
+            default=30.0, description="Seconds an idle connection stays open"
+        )
+        request_timeout: float = Field(
+            default=60.0, description="Timeout in seconds for LLM and embedder requests"
+        )
+        qdrant_timeout: int = Field(
+            default=10, description="Timeout in seconds for Qdrant requests"
+        )
+        qdrant_prefer_grpc: bool = Field(
+            default=False, description="Talk to Qdrant over one multiplexed gRPC channel"
+        )
+        qdrant_grpc_port: int = Field(
+            default=6334, description="Qdrant gRPC port"
+        )
+
+        # Embedding cache config
+        embedding_cache_size: int = Field(
+            default=10000, description="Embeddings kept in memory (0 disables the cache)"
+        )
+        embedding_cache_path: str = Field(
+            default="", description="SQLite file for persistent embeddings (empty keeps them in memory only)"
+        )
+
+    # Seconds before a failed client build is retried, doubling per failure
+    INIT_RETRY_MIN: ClassVar[float] = 1.0
+    INIT_RETRY_MAX: ClassVar[float] = 60.0
+
     def __init__(self):
         self.type = "filter"
         self.valves = self.Valves(
             **{k: os.getenv(k, v.default) for k, v in self.Valves.model_fields.items()}
         )
         self.m = None  # Initialize self.m to None
+        self.write_queue = None
+        self.ledger = None
+        self.search_cache = None
+        # Last successful search per user, served when a search misses its deadline
+        self.last_memories: "OrderedDict[str, Any]" = OrderedDict()
+        self.background_searches: set = set()
+        # Prefetch queries held until the user's queued writes have landed
+        self.pending_prefetches: "OrderedDict[str, str]" = OrderedDict()
+        # Replies already queued by outlet, so inlet does not queue them again
+        self.outlet_replies: "OrderedDict[str, bytes]" = OrderedDict()
+        self.gate = None
+        # Low-information messages held per user until their next write
+        self.deferred: "OrderedDict[str, List[Tuple[str, bytes, dict]]]" = OrderedDict()
+        self.degraded_responses = 0
+        self.metrics = Metrics()
+        self.metrics.register(
+            "write_queue", lambda: self.write_queue.stats() if self.write_queue else {}
+        )
+        self.metrics.register(
+            "search_cache", lambda: self.search_cache.stats() if self.search_cache else {}
+        )
+        self.metrics.register(
+            "embedding_cache",
+            lambda: self.m.embedding_model.stats()
+            if self.m is not None and isinstance(self.m.embedding_model, CachedEmbedder)
+            else {},
+        )
+        self.metrics.register(
+            "message_gate",
+            lambda: {**self.gate.stats(), "deferred_users": len(self.deferred)}
+            if self.gate
+            else {},
+        )
+        self.metrics.register(
+            "circuit_breakers",
+            lambda: {
+                f"{name}_{key}": value
+                for name, breaker in [
+                    ("client_init", self.init_breaker),
+                    *self.breakers.get(id(self.m), {}).items(),
+                ]
+                for key, value in breaker.stats().items()
+            },
+        )
+        self.metrics.register(
+            "retrieval",
+            lambda: {
+                "degraded_responses": self.degraded_responses,
+                "background_searches": len(self.background_searches),
+            },
+        )
+        self.metrics.register(
+            "compaction",
+            lambda: {**self.compaction_totals, "pending_users": len(self.compaction_users)},
+        )
+        self.metrics_task = None
+        # Users written since the last compaction pass
+        self.compaction_users: "OrderedDict[str, None]" = OrderedDict()
+        self.compaction_totals = {"passes": 0, "users": 0, "scanned": 0, "merged": 0, "removed": 0}
+        self.compaction_task = None
+        # Client id -> the user compaction running on it, cancelled if it is retired
+        self.compaction_runs: Dict[int, asyncio.Task] = {}
+        # Pooled clients survive valve updates unless their own settings change
+        self.clients: Dict[str, Tuple[tuple, Any]] = {}
+        self.retired_clients: List[Any] = []
+        # In-flight calls per memory client; a swapped-out client is closed once idle
+        self.borrowed: Dict[int, int] = {}
+        # Circuit breakers per memory client, keyed like borrowed
+        self.breakers: Dict[int, Dict[str, CircuitBreaker]] = {}
+        self.memory_lock = asyncio.Lock()
+        self.swap_task = None
+        self.retiring: set = set()
+        # Client builds go through their own breaker, which opens on the
+        # first failure; its reset timeout doubles while builds keep failing
+        self.init_breaker = CircuitBreaker(
+            "client_init", failure_threshold=1, reset_timeout=self.INIT_RETRY_MIN
+        )
+        self.init_failures = 0
         pass
 
     async def on_valves_updated(self):
-        print("initializing mem0 client")
-        print(self.valves)
-        self.m = await self.init_mem_zero()
-        print("mem0 client initialized")
+        # Requests keep using the current client while the new one is built
+        if self.swap_task is not None:
+            self.swap_task.cancel()
+        self.swap_task = asyncio.create_task(self.swap_memory())
+        self.start_metrics()
+        self.start_compaction()
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
-        pass
+        self.start_metrics()
+        self.start_compaction()
+        # Pay client construction and cold calls before the first user does
+        try:
+            await self.warm_up(await self.get_memory())
+        except Exception as e:
+            print(f"mem0 warmup failed, retrying on first request: {str(e)}")
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
-        pass
+        if self.swap_task is not None:
+            self.swap_task.cancel()
+        if self.compaction_task is not None:
+            self.compaction_task.cancel()
+            self.compaction_task = None
+        await self.flush_deferred()
+        await self.close_write_queue()
+        if self.retiring:
+            await asyncio.gather(*self.retiring, return_exceptions=True)
+        self.close_ledger()
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+            self.metrics_task = None
+        self.dump_metrics()
+        self.close_embedder(self.m)
+        self.close_graph(self.m)
+        self.close_clients()
+
+    async def get_memory(self):
+        """Returns the memory client, building it on first use.
+
+        While the client_init circuit is open every caller, including those
+        queued behind the lock, fails at once instead of building it again.
+        """
+        if self.m is None and self.swap_task is not None:
+            await asyncio.wait({self.swap_task})
+        if self.m is None and self.init_breaker.retry_in() > 0:
+            self.init_breaker.rejected += 1
+            raise CircuitOpenError("client_init is unavailable (circuit open)")
+        async with self.memory_lock:
+            if self.m is None:
+                print("Initializing mem0 client")
+                self.m = await self.build_memory()
+        return self.m
+
+    async def build_memory(self):
+        """Builds a memory client behind the client_init breaker."""
+        try:
+            memory = await self.init_breaker.acall(self.init_mem_zero)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            self.init_failures += 1
+            self.init_breaker.reset_timeout = min(
+                self.INIT_RETRY_MAX, self.INIT_RETRY_MIN * 2 ** (self.init_failures - 1)
+            )
+            self.metrics.inc("client_init_errors")
+            raise
+        self.init_failures = 0
+        self.init_breaker.reset_timeout = self.INIT_RETRY_MIN
+        return memory
+
+    async def warm_up(self, memory):
+        """Runs a throwaway search so the embedder, Qdrant and pools are warm."""
+        with self.metrics.time("warmup"):
+            await memory.search(query="warmup", user_id="__warmup__", limit=1)
+
+    async def swap_memory(self):
+        """Builds and warms a client from the current valves, then swaps it in."""
+        print("initializing mem0 client")
+        print(self.valves)
+        memory = None
+        try:
+            memory = await self.build_memory()
+            await self.warm_up(memory)
+        except Exception as e:
+            self.metrics.inc("client_swap_errors")
+            print(f"New mem0 client is unhealthy, keeping the current one: {str(e)}")
+            self.close_embedder(memory)
+            self.close_graph(memory)
+            self.breakers.pop(id(memory), None)
+            return
+        retired = (self.m, self.write_queue, self.ledger, self.retired_clients)
+        self.m = memory
+        self.write_queue = None
+        self.ledger = None
+        self.search_cache = None
+        self.gate = None
+        self.retired_clients = []
+        self.metrics.inc("client_swaps")
+        print("mem0 client initialized")
+        task = asyncio.create_task(self.retire_memory(*retired))
+        self.retiring.add(task)
+        task.add_done_callback(self.retiring.discard)
+
+    async def retire_memory(self, memory, queue, ledger, clients: List[Any]):
+        """Drains a swapped-out client's writes and closes it once idle."""
+        if queue is not None:
+            await queue.close(self.valves.write_queue_flush_timeout)
+            print(f"Memory write queue closed: {queue.stats()}")
+        run = self.compaction_runs.pop(id(memory), None)
+        if run is not None:
+            # A rate-limited pass can outlast the drain; stop it before the client closes
+            run.cancel()
+        deadline = time.monotonic() + self.valves.write_queue_flush_timeout
+        while self.borrowed.get(id(memory)) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.close_embedder(memory)
+        self.close_graph(memory)
+        self.breakers.pop(id(memory), None)
+        if ledger is not None:
+            await asyncio.to_thread(ledger.close)
+        for client in clients:
+            client.close()
+
+    @contextmanager
+    def borrow_memory(self):
+        """Yields the current client, counting the use so a swap waits for it."""
+        memory = self.m
+        key = id(memory)
+        self.borrowed[key] = self.borrowed.get(key, 0) + 1
+        try:
+            yield memory
+        finally:
+            self.borrowed[key] -= 1
+            if not self.borrowed[key]:
+                del self.borrowed[key]
+
+    def start_metrics(self):
+        if self.metrics_task is None and self.valves.metrics_path:
+            self.metrics_task = asyncio.create_task(self._write_metrics())
+
+    async def _write_metrics(self):
+        while self.valves.metrics_path:
+            await asyncio.sleep(self.valves.metrics_interval)
+            await asyncio.to_thread(self.dump_metrics)
+        self.metrics_task = None
+
+    def dump_metrics(self):
+        if self.valves.metrics_path:
+            try:
+                self.metrics.dump(self.valves.metrics_path)
+            except Exception as e:
+                print(f"Failed to write metrics: {str(e)}")
+
+    def start_compaction(self):
+        if self.compaction_task is None and self.valves.compaction_enabled:
+            self.compaction_task = asyncio.create_task(self._compact_periodically())
+
+    async def _compact_periodically(self):
+        while self.valves.compaction_enabled:
+            await asyncio.sleep(self.valves.compaction_interval)
+            try:
+                await self.compact_pending()
+            except Exception as e:
+                print(f"Memory compaction failed: {str(e)}")
+        self.compaction_task = None
+
+    async def compaction_idle(self):
+        """Waits until no writes are pending and every dependency is reachable."""
+        while (self.write_queue is not None and not self.write_queue.idle) or self.circuit_retry_in(
+            "embedder", "vector_store", "llm"
+        ) > 0:
+            await asyncio.sleep(1.0)
+
+    async def compact_pending(self):
+        """Compacts the users written since the last pass, one at a time."""
+        if not self.compaction_users:
+            return
+        compactor = MemoryCompactor(
+            threshold=self.valves.compaction_threshold,
+            use_llm=self.valves.compaction_use_llm,
+            io_rate=self.valves.compaction_io_rate,
+            llm_rate=self.valves.compaction_llm_rate,
+            max_memories=self.valves.compaction_max_memories,
+            idle=self.compaction_idle,
+        )
+        self.compaction_totals["passes"] += 1
+        while self.compaction_users and self.valves.compaction_enabled:
+            user_id, _ = self.compaction_users.popitem(last=False)
+            # Live traffic goes first; compaction only starts a user when idle
+            await self.compaction_idle()
+            with self.borrow_memory() as memory:
+                run = asyncio.create_task(compactor.compact_user(memory, user_id))
+                self.compaction_runs[id(memory)] = run
+                try:
+                    with self.metrics.time("compaction"):
+                        report = await run
+                except asyncio.CancelledError:
+                    if self.compaction_runs.get(id(memory)) is run:
+                        raise
+                    # The client was retired mid-pass; redo the user on the new one
+                    self.compaction_users[user_id] = None
+                    print(f"Compaction for user {user_id} stopped by a client swap")
+                    continue
+                except Exception as e:
+                    print(f"Compaction failed for user {user_id}: {str(e)}")
+                    continue
+                finally:
+                    if self.compaction_runs.get(id(memory)) is run:
+                        del self.compaction_runs[id(memory)]
+            self.compaction_totals["users"] += 1
+            for key in ("scanned", "merged", "removed"):
+                self.compaction_totals[key] += report[key]
+            if report["merged"] or report["removed"]:
+                if self.search_cache:
+                    self.search_cache.invalidate(user_id)
+                self.last_memories.pop(user_id, None)
+                print(
+                    f"Compacted memories for user {user_id}: {report['scanned']} scanned, "
+                    f"{report['merged']} merged, {report['removed']} removed"
+                )
+
+    def get_write_queue(self) -> MemoryWriteQueue:
+        if self.write_queue is None:
+            self.write_queue = MemoryWriteQueue(
+                self.add_message_to_mem0,
+                max_pending=self.valves.write_queue_max_pending,
+                workers=self.valves.write_queue_workers,
+                max_batch=self.valves.write_queue_max_batch,
+                put_timeout=self.valves.write_queue_put_timeout,
+            )
+            self.write_queue.start()
+        return self.write_queue
+
+    async def close_write_queue(self):
+        if self.write_queue is not None:
+            queue, self.write_queue = self.write_queue, None
+            await queue.close(self.valves.write_queue_flush_timeout)
+            print(f"Memory write queue closed: {queue.stats()}")
+
+    async def get_ledger(self) -> Optional[IngestionLedger]:
+        if self.ledger is None and self.valves.ledger_path:
+            ledger = await asyncio.to_thread(
+                IngestionLedger,
+                self.valves.ledger_path,
+                self.valves.ledger_max_age_days * 86400,
+            )
+            if self.ledger is None:
+                self.ledger = ledger
+            else:
+                ledger.close()
+        return self.ledger
+
+    def close_ledger(self):
+        if self.ledger is not None:
+            self.ledger.close()
+            self.ledger = None
+
+    def get_gate(self) -> Optional[MessageGate]:
+        if self.gate is None and self.valves.gate_enabled:
+            self.gate = MessageGate(
+                min_chars=self.valves.gate_min_chars,
+                max_stopword_ratio=self.valves.gate_max_stopword_ratio,
+                skip_pattern=self.valves.gate_skip_pattern,
+                min_score=self.valves.gate_min_score,
+                defer=self.valves.gate_defer_limit > 0,
+            )
+        return self.gate
+
+    async def queue_message(self, user_id, chat_id, message, occurrence: int = 0):
+        """Queue a message for storage unless the gate holds it back.
+
+        chat_id is the ledger's chat key and occurrence counts earlier copies
+        of the message in the chat. Deferred messages ride along with the
+        user's next passing message, or are written together once
+        gate_defer_limit of them pile up.
+        """
+        gate = self.get_gate()
+        verdict = gate.classify(message["content"]) if gate else "pass"
+        if verdict == "skip":
+            return
+        held = self.deferred.pop(user_id, [])
+        held.append((chat_id, IngestionLedger.digest(message, occurrence), message))
+        if verdict == "defer" and len(held) < self.valves.gate_defer_limit:
+            self.deferred[user_id] = held
+            while len(self.deferred) > self.valves.write_queue_max_pending:
+                evicted_user, evicted = self.deferred.popitem(last=False)
+                self.metrics.inc("gate_deferred_evicted", len(evicted))
+                print(
+                    f"Deferred message buffer full, dropped {len(evicted)} message(s) "
+                    f"for user {evicted_user}"
+                )
+            return
+        for entry in held:
+            await self.write_message(user_id, *entry)
+
+    async def flush_deferred(self):
+        while self.deferred:
+            user_id, held = self.deferred.popitem(last=False)
+            for entry in held:
+                await self.write_message(user_id, *entry)
+
+    async def write_message(self, user_id, chat_id, digest, message):
+        """Queue a message for storage unless the ledger has already seen it.
+
+        The ledger records the message only once mem0 has stored it.
+        """
+        ledger = await self.get_ledger()
+        if ledger and not await asyncio.to_thread(ledger.claim, user_id, chat_id, [digest]):
+            print(f"Skipping already ingested {message['role']} message")
+            return
+        if not await self.get_write_queue().put(user_id, (chat_id, digest, message)):
+            if ledger:
+                ledger.release(user_id, chat_id, [digest])
+
+    def close_embedder(self, memory):
+        if memory is not None and isinstance(memory.embedding_model, CachedEmbedder):
+            print(f"Embedding cache closed: {memory.embedding_model.stats()}")
+            memory.embedding_model.close()
+
+    def get_search_cache(self) -> Optional[SearchCache]:
+        if self.search_cache is None and self.valves.search_cache_size > 0:
+            self.search_cache = SearchCache(
+                max_entries=self.valves.search_cache_size,
+                max_users=self.valves.search_cache_max_users,
+                ttl=self.valves.search_cache_ttl,
+                threshold=self.valves.search_cache_threshold,
+                embed_first=isinstance(self.m.embedding_model, CachedEmbedder),
+            )
+        return self.search_cache
+
+    async def embed_query(self, query: str) -> List[float]:
+        with self.borrow_memory() as memory:
+            return await asyncio.to_thread(memory.embedding_model.embed, query, "search")
+
+    async def search_memories(self, user_id: str, query: str):
+        """Search mem0, reusing cached results for repeated or near-duplicate queries."""
+        cache = self.get_search_cache()
+        if cache is None:
+            return await self.run_search(user_id, query)
+        return await cache.fetch(
+            user_id,
+            query,
+            lambda: self.run_search(user_id, query),
+            self.embed_query,
+        )
+
+    async def run_search(self, user_id: str, query: str):
+        with self.borrow_memory() as memory, self.metrics.time("memory_search"):
+            return await memory.search(user_id=user_id, query=query)
+
+    async def search_with_deadline(self, user_id: str, query: str):
+        """Search within search_timeout, falling back to the user's last memories.
+
+        Memories prefetched from the previous reply are added to the results,
+        or served alone if the search misses the deadline. A search that
+        misses it keeps running in the background so its results still warm
+        the caches for the next request.
+        """
+        prefetched = self.search_cache.take_next(user_id) if self.search_cache else None
+        task = asyncio.create_task(self.search_memories(user_id, query))
+        task.add_done_callback(lambda t: self._remember_memories(user_id, t))
+        with self.metrics.time("retrieval"):
+            if self.valves.search_timeout <= 0:
+                return self.merge_results(await task, prefetched)
+            try:
+                return self.merge_results(
+                    await asyncio.wait_for(asyncio.shield(task), self.valves.search_timeout),
+                    prefetched,
+                )
+            except asyncio.TimeoutError:
+                self.degraded_responses += 1
+                self.background_searches.add(task)
+                task.add_done_callback(self.background_searches.discard)
+                print(
+                    f"Memory search exceeded {self.valves.search_timeout}s, "
+                    f"degraded responses: {self.degraded_responses}"
+                )
+                return prefetched or self.last_memories.get(user_id) or {"results": []}
+
+    @staticmethod
+    def merge_results(results: dict, prefetched: Optional[dict]) -> dict:
+        """Adds prefetched memories the search did not return; context building ranks them."""
+        if not prefetched:
+            return results
+        found = results.get("results", [])
+        seen = {result.get("id") for result in found}
+        extra = [r for r in prefetched.get("results", []) if r.get("id") not in seen]
+        return {**results, "results": found + extra}
+
+    async def retrieve_memories(self, user_id: str, query: str):
+        """Vector search for inlet, skipped while its backends' circuits are open."""
+        if self.circuit_retry_in("embedder", "vector_store") > 0:
+            # Fail fast instead of waiting on a backend known to be down
+            self.metrics.inc("circuit_skipped_searches")
+            return {"results": []}
+        try:
+            return await self.search_with_deadline(user_id, query)
+        except CircuitOpenError:
+            self.metrics.inc("circuit_skipped_searches")
+            return {"results": []}
+
+    async def search_relations(self, user_id: str, query: str) -> List[dict]:
+        """Graph relations for the query, as results ranked alongside memories.
 
-    async def add_message_to_mem0(self, user_id, message):
-        await self.m.add(user_id=user_id, messages=[message])
-        print(f"Added message to mem0: {message}")
+        Relations that miss graph_search_timeout are left out; the prompt
+        goes ahead with the vector memories alone.
+        """
+        with self.borrow_memory() as memory:
+            graph = getattr(memory, "graph", None)
+            if graph is None or self.circuit_retry_in("graph") > 0:
+                return []
+            search = asyncio.to_thread(graph.search, query, {"user_id": user_id})
+            try:
+                with self.metrics.time("graph_retrieval"):
+                    if self.valves.graph_search_timeout > 0:
+                        relations = await asyncio.wait_for(
+                            search, self.valves.graph_search_timeout
+                        )
+                    else:
+                        relations = await search
+            except asyncio.TimeoutError:
+                self.metrics.inc("graph_degraded_responses")
+                print(f"Graph search exceeded {self.valves.graph_search_timeout}s")
+                return []
+            except Exception as e:
+                self.metrics.inc("graph_search_errors")
+                print(f"Graph search failed: {str(e)}")
+                return []
+        return [
+            {
+                "memory": " ".join(
+                    str(relation[key]).replace("_", " ")
+                    for key in ("source", "relationship", "destination")
+                ),
+                "score": self.valves.graph_relation_score,
+            }
+            for relation in relations or []
+        ]
+
+    async def add_relations(self, memory, user_id: str, messages: List[dict]):
+        """Writes the messages' entity relations to the graph, if one is configured."""
+        graph = getattr(memory, "graph", None)
+        if graph is None:
+            return
+        data = "\n".join(m["content"] for m in messages if m["role"] != "system")
+        try:
+            await asyncio.to_thread(graph.add, data, {"user_id": user_id})
+        except Exception as e:
+            # The vector write decides the batch's fate; the graph is best effort
+            self.metrics.inc("graph_add_errors")
+            print(f"Graph write failed for user {user_id}: {str(e)}")
+
+    def _remember_memories(self, user_id: str, task: asyncio.Task):
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.last_memories[user_id] = task.result()
+        self.last_memories.move_to_end(user_id)
+        while len(self.last_memories) > self.valves.search_cache_max_users:
+            self.last_memories.popitem(last=False)
+
+    def circuit_retry_in(self, *names: str) -> float:
+        """Seconds until every named dependency of the live client accepts calls."""
+        breakers = self.breakers.get(id(self.m), {})
+        return max(
+            (breakers[name].retry_in() for name in names if name in breakers),
+            default=0.0,
+        )
+
+    async def add_message_to_mem0(self, user_id, entries: List[Tuple[str, bytes, dict]]):
+        messages = [message for _, _, message in entries]
+        try:
+            while True:
+                # Hold the batch while a dependency is down rather than hammer it;
+                # the queue buffers new messages meanwhile and sheds them once full
+                wait = self.circuit_retry_in("embedder", "vector_store", "llm")
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                try:
+                    with self.borrow_memory() as memory, self.metrics.time(
+                        "memory_add"
+                    ), BackendFailures.collect() as failures:
+                        # Graph writes merge nodes and edges, so a retry does not duplicate them
+                        await asyncio.gather(
+                            memory.add(user_id=user_id, messages=messages),
+                            self.add_relations(memory, user_id, messages),
+                        )
+                        if failures:
+                            # mem0 logged and skipped part of the write. A circuit that
+                            # opened meanwhile holds the batch like one open before it;
+                            # otherwise the batch fails and its messages are released
+                            if self.circuit_retry_in("embedder", "vector_store", "llm") > 0 or any(
+                                isinstance(e, CircuitOpenError) for e in failures
+                            ):
+                                raise CircuitOpenError(f"circuit opened during the add: {failures[0]}")
+                            raise failures[0]
+                    break
+                except CircuitOpenError:
+                    self.metrics.inc("circuit_held_writes")
+        except BaseException:
+            if self.ledger:
+                for chat_id, digest, _ in entries:
+                    self.ledger.release(user_id, chat_id, [digest])
+            raise
+        finally:
+            # Cached searches may no longer reflect this user's memories
+            if self.search_cache:
+                self.search_cache.invalidate(user_id)
+            # The worker still holds this user, so only waiting writes count
+            if self.write_queue is None or not self.write_queue.has_pending(user_id):
+                query = self.pending_prefetches.pop(user_id, None)
+                if query is not None:
+                    self.prefetch(user_id, query)
+        ledger = await self.get_ledger()
+        if ledger:
+            for chat_id, digest, _ in entries:
+                await asyncio.to_thread(ledger.commit, user_id, chat_id, [digest])
+        if self.valves.compaction_enabled:
+            self.compaction_users[user_id] = None
+            self.compaction_users.move_to_end(user_id)
+            while len(self.compaction_users) > self.valves.write_queue_max_pending:
+                self.compaction_users.popitem(last=False)
+        print(f"Added {len(messages)} message(s) to mem0 for user {user_id}")
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         """Inject memory context into the prompt before sending to the model."""
 
-        if self.m is None:
-            print("Initializing mem0 client")
-            self.m = await self.init_mem_zero()
-
         print("DEBUG: Inlet method triggered")
 
         print(f"Current module: {__name__}")
@@ -109,6 +2178,7 @@ class Pipeline:
         if user and "id" in user:
             current_user_id = user["id"]
         print(f"Using user ID: {current_user_id}")
+        chat_id = body.get("metadata", {}).get("chat_id")
 
         # Find latest user message for memory query
         print("Messages structure:")
@@ -117,75 +2187,433 @@ class Pipeline:
 
         user_message = None
         assistant_message = None
-        for msg in reversed(messages):
-            if msg.get("role") == "user":
-                user_message = msg.get("content")
+        user_index = assistant_index = None
+        for i in reversed(range(len(messages))):
+            if messages[i].get("role") == "user":
+                user_index, user_message = i, messages[i].get("content")
                 print(f"Found user message: {user_message[:50]}...")
                 break
 
-        for msg in reversed(messages):
-            if msg.get("role") == "assistant":
-                assistant_message = msg.get("content")
+        for i in reversed(range(len(messages))):
+            if messages[i].get("role") == "assistant":
+                assistant_index, assistant_message = i, messages[i].get("content")
                 print(f"Found assistant message: {assistant_message[:50]}...")
                 break
+        # Chats without an ID are told apart in the ledger by their opening message
+        ledger_chat = IngestionLedger.chat_key(chat_id, messages)
 
         if not user_message:
             return body
 
+        inlet_start = time.perf_counter()
         try:
+            # Without a client the request goes ahead without memories
+            await self.get_memory()
             # Retrieve relevant memories and update memory with current message
             print("DEBUG: MemoryClient initialized:", self.m)
             print("DEBUG: Getting memories...")
-            memories = await self.m.search(user_id=current_user_id, query=user_message)
+            # Vector and graph lookups run side by side, each within its own budget
+            memories, relations = await asyncio.gather(
+                self.retrieve_memories(current_user_id, user_message),
+                self.search_relations(current_user_id, user_message),
+            )
+            if self.search_cache:
+                print("DEBUG: Search cache stats:", self.search_cache.stats())
 
-            if assistant_message:
-                asyncio.create_task(
-                    self.add_message_to_mem0(
-                        current_user_id,
-                        {"role": "assistant", "content": assistant_message},
-                    )
+            # Queue the latest exchange for a coalesced background write
+            if assistant_message and not self.reply_queued(
+                current_user_id, chat_id, assistant_message
+            ):
+                await self.queue_message(
+                    current_user_id,
+                    ledger_chat,
+                    {"role": "assistant", "content": assistant_message},
+                    IngestionLedger.occurrence(messages, assistant_index),
                 )
 
             # Add current user message to memory
-            asyncio.create_task(
-                self.add_message_to_mem0(
-                    user_id=current_user_id,
-                    message={"role": "user", "content": user_message},
-                )
+            await self.queue_message(
+                current_user_id,
+                ledger_chat,
+                {"role": "user", "content": user_message},
+                IngestionLedger.occurrence(messages, user_index),
             )
 
             print("DEBUG: Retrieved memories:", memories)
 
-            # Inject memory context into system message
-            if memories:
-                memory_context = "\n\nRelevant memories:\n" + "\n".join(
-                    f"- {mem['memory']}" for mem in memories["results"]
+            with self.metrics.time("prompt_assembly"):
+                # Inject the best memories that fit the context budget
+                memory_context = self.build_context(
+                    memories.get("results", []) + relations
                 )
 
-            # Find or create system message
-            system_message = next(
-                (msg for msg in messages if msg["role"] == "system"), None
-            )
-            if system_message:
-                system_message["content"] += memory_context
-            else:
-                messages.insert(
-                    0,
-                    {
-                        "role": "system",
-                        "content": f"Use these memories to enhance your response:\n{memory_context}",
-                    },
+                # Find or create system message
+                system_message = next(
+                    (msg for msg in messages if msg["role"] == "system"), None
                 )
+                if not memory_context:
+                    # Nothing relevant enough; leave the prompt untouched
+                    pass
+                elif system_message:
+                    system_message["content"] += memory_context
+                else:
+                    messages.insert(
+                        0,
+                        {
+                            "role": "system",
+                            "content": f"Use these memories to enhance your response:\n{memory_context}",
+                        },
+                    )
 
             # Update body with modified messages
             body["messages"] = messages
 
         except Exception as e:
+            self.metrics.inc("inlet_errors")
             print(f"Mem0 integration error: {str(e)}")
 
+        self.metrics.observe("inlet", time.perf_counter() - inlet_start)
+        return body
+
+    async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        """Queue the finished reply and prefetch memories for the next turn."""
+        if not self.valves.prefetch_enabled:
+            return body
+        messages = body.get("messages", [])
+        reply_index = next(
+            (i for i in reversed(range(len(messages))) if messages[i].get("role") == "assistant"),
+            None,
+        )
+        reply = messages[reply_index].get("content") if reply_index is not None else None
+        if not reply:
+            return body
+
+        user_id = user["id"] if user and "id" in user else self.valves.user_id
+        chat_id = body.get("chat_id") or body.get("metadata", {}).get("chat_id")
+        try:
+            with self.metrics.time("outlet"):
+                await self.get_memory()
+                # Written now rather than when the next inlet sees it in history
+                self.remember_reply(user_id, chat_id, reply)
+                await self.queue_message(
+                    user_id,
+                    IngestionLedger.chat_key(chat_id, messages),
+                    {"role": "assistant", "content": reply},
+                    IngestionLedger.occurrence(messages, reply_index),
+                )
+                self.schedule_prefetch(user_id, reply[-self.valves.prefetch_query_chars :])
+        except Exception as e:
+            self.metrics.inc("outlet_errors")
+            print(f"Mem0 outlet error: {str(e)}")
         return body
 
+    def schedule_prefetch(self, user_id: str, query: str):
+        """Prefetches now, or once the user's queued writes are done.
+
+        A write invalidates the user's cached searches, so a prefetch that
+        finished before the reply was stored would be thrown away.
+        """
+        if self.write_queue is not None and self.write_queue.busy(user_id):
+            self.pending_prefetches[user_id] = query
+            self.pending_prefetches.move_to_end(user_id)
+            while len(self.pending_prefetches) > self.valves.write_queue_max_pending:
+                self.pending_prefetches.popitem(last=False)
+            return
+        self.prefetch(user_id, query)
+
+    def prefetch(self, user_id: str, query: str):
+        """Searches with the reply as a stand-in for the user's next message.
+
+        This warms the embedder, the connection pools and the search cache.
+        The results are kept for the user's next inlet, which adds them to
+        its own search, unless a write for the user lands first.
+        """
+        if self.circuit_retry_in("embedder", "vector_store") > 0:
+            return
+        task = asyncio.create_task(self.prefetch_next(user_id, query))
+        task.add_done_callback(lambda t: self._remember_memories(user_id, t))
+        self.background_searches.add(task)
+        task.add_done_callback(self.background_searches.discard)
+        self.metrics.inc("prefetches")
+
+    async def prefetch_next(self, user_id: str, query: str):
+        cache = self.get_search_cache()
+        generation = cache.generation(user_id) if cache else 0
+        results = await self.search_memories(user_id, query)
+        if cache:
+            cache.put_next(user_id, results, generation)
+        return results
+
+    def remember_reply(self, user_id: str, chat_id: Optional[str], reply: str):
+        key = f"{user_id}:{chat_id}"
+        self.outlet_replies[key] = hashlib.blake2b(reply.encode(), digest_size=16).digest()
+        self.outlet_replies.move_to_end(key)
+        while len(self.outlet_replies) > self.valves.write_queue_max_pending:
+            self.outlet_replies.popitem(last=False)
+
+    def reply_queued(self, user_id: str, chat_id: Optional[str], reply: str) -> bool:
+        digest = hashlib.blake2b(reply.encode(), digest_size=16).digest()
+        return self.outlet_replies.get(f"{user_id}:{chat_id}") == digest
+
+    def build_context(self, results: List[dict]) -> str:
+        builder = ContextBuilder(
+            max_results=self.valves.context_max_results,
+            min_score=self.valves.context_min_score,
+            token_budget=self.valves.context_token_budget,
+            duplicate_threshold=self.valves.context_duplicate_threshold,
+        )
+        return builder.build(results)
+
+    def reuse_client(self, name: str, settings: tuple, build: Callable[[], Any]):
+        """Returns the pooled client for name, rebuilding it only when settings change."""
+        current = self.clients.get(name)
+        if current is not None and current[0] == settings:
+            return current[1]
+        client = build()
+        self.clients[name] = (settings, client)
+        if current is not None:
+            # The live memory client may still use it; closed when that is retired
+            self.retired_clients.append(current[1])
+        return client
+
+    def close_clients(self):
+        for _, client in self.clients.values():
+            client.close()
+        self.clients.clear()
+        for client in self.retired_clients:
+            client.close()
+        self.retired_clients = []
+
+    def connection_limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.valves.max_connections,
+            max_keepalive_connections=self.valves.max_keepalive_connections,
+            keepalive_expiry=self.valves.keepalive_expiry,
+        )
+
+    def use_http_pool(self, component):
+        """Points an OpenAI-compatible mem0 LLM or embedder at the shared pool."""
+        client = getattr(component, "client", None)
+        if not hasattr(client, "with_options"):
+            return
+        limits = self.connection_limits()
+        pool = self.reuse_client(
+            "http",
+            (limits.max_connections, limits.max_keepalive_connections, limits.keepalive_expiry),
+            lambda: httpx.Client(limits=limits),
+        )
+        component.client = client.with_options(
+            http_client=pool, timeout=self.valves.request_timeout
+        )
+
+    def embedded_qdrant(self):
+        """Opens Qdrant in local mode inside this process."""
+        path = self.valves.qdrant_path
+        if path == ":memory:":
+            client = QdrantClient(location=path)
+        else:
+            # Calls are serialized below, so the SQLite handle can cross threads
+            client = QdrantClient(path=path, force_disable_check_same_thread=True)
+        client._client = LockedQdrantLocal(client._client)
+        return client
+
+    def partition_vector_store(self, memory):
+        """Indexes and tunes the collection and optionally spreads users over collections."""
+        store = memory.vector_store
+        shards = [store]
+        if self.valves.collection_shards > 1:
+            shards = [
+                Qdrant(
+                    collection_name=f"{store.collection_name}_{i}",
+                    embedding_model_dims=store.embedding_model_dims,
+                    client=store.client,
+                    on_disk=store.on_disk,
+                )
+                for i in range(self.valves.collection_shards)
+            ]
+            memory.vector_store = ShardedVectorStore(shards)
+        if self.valves.qdrant_path:
+            # Local mode searches exactly and ignores payload indexes
+            return
+        for shard in shards:
+            if self.valves.qdrant_user_index:
+                self.index_user_field(shard)
+            self.tune_vector_store(shard)
+
+    def index_user_field(self, store):
+        # Tenant indexes need Qdrant 1.11+; older servers get a plain keyword index
+        schemas = [
+            models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True),
+            models.PayloadSchemaType.KEYWORD,
+        ]
+        for schema in schemas:
+            try:
+                store.client.create_payload_index(
+                    collection_name=store.collection_name,
+                    field_name="user_id",
+                    field_schema=schema,
+                )
+                return
+            except Exception as e:
+                error = e
+        print(f"Could not index user_id on {store.collection_name}: {str(error)}")
+
+    def quantization_config(self):
+        if self.valves.quantization == "scalar":
+            return models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(
+                    type=models.ScalarType.INT8,
+                    always_ram=self.valves.quantization_always_ram,
+                )
+            )
+        if self.valves.quantization == "binary":
+            return models.BinaryQuantization(
+                binary=models.BinaryQuantizationConfig(
+                    always_ram=self.valves.quantization_always_ram
+                )
+            )
+        if self.valves.quantization != "none":
+            print(f"Unknown quantization {self.valves.quantization!r}, using none")
+        return None
+
+    def search_params(self):
+        quantization = None
+        if self.quantization_config() is not None:
+            quantization = models.QuantizationSearchParams(
+                rescore=self.valves.quantization_rescore,
+                oversampling=self.valves.quantization_oversampling,
+            )
+        if not self.valves.hnsw_ef and quantization is None:
+            return None
+        return models.SearchParams(
+            hnsw_ef=self.valves.hnsw_ef or None, quantization=quantization
+        )
+
+    def tune_vector_store(self, store):
+        """Brings the collection's HNSW and quantization settings in line with the valves."""
+        try:
+            current = store.client.get_collection(store.collection_name).config
+            changes = {}
+            if (current.hnsw_config.m, current.hnsw_config.ef_construct) != (
+                self.valves.hnsw_m,
+                self.valves.hnsw_ef_construct,
+            ):
+                changes["hnsw_config"] = models.HnswConfigDiff(
+                    m=self.valves.hnsw_m, ef_construct=self.valves.hnsw_ef_construct
+                )
+            quantization = self.quantization_config()
+            if current.quantization_config != quantization:
+                changes["quantization_config"] = quantization or models.Disabled.DISABLED
+            if changes:
+                # Qdrant rebuilds the index in the background; searches keep working
+                store.client.update_collection(
+                    collection_name=store.collection_name, **changes
+                )
+                print(f"Updated {store.collection_name}: {', '.join(changes)}")
+        except Exception as e:
+            print(f"Could not tune {store.collection_name}: {str(e)}")
+
+        params = self.search_params()
+        if params is None:
+            return
+
+        # mem0's search has no way to pass search params, so issue the query here
+        def search(query, vectors, limit=5, filters=None):
+            hits = store.client.query_points(
+                collection_name=store.collection_name,
+                query=vectors,
+                query_filter=store._create_filter(filters) if filters else None,
+                limit=limit,
+                search_params=params,
+            )
+            return hits.points
+
+        store.search = search
+
+    def build_graph(self, config: dict):
+        """Connects mem0's Neo4j graph memory.
+
+        mem0 would await graph and vector work together on every search and
+        add, so its enable_graph stays off and the pipeline drives the graph
+        itself, giving each lookup its own budget.
+        """
+        from mem0.configs.base import MemoryConfig
+        from mem0.memory.graph_memory import MemoryGraph
+
+        graph_config = {
+            "provider": "neo4j",
+            "config": {
+                "url": self.valves.neo4j_url,
+                "username": self.valves.neo4j_username,
+                "password": self.valves.neo4j_password,
+            },
+        }
+        graph = MemoryGraph(MemoryConfig(**config, graph_store=graph_config))
+        self.use_http_pool(graph.llm)
+        self.use_http_pool(graph.embedding_model)
+        return graph
+
+    def close_graph(self, memory):
+        driver = getattr(getattr(memory, "graph", None), "graph", None)
+        if hasattr(driver, "close"):
+            driver.close()
+
+    def guard_memory(self, memory):
+        """Puts each backend the memory client calls behind its own circuit breaker."""
+        if self.valves.breaker_failure_threshold <= 0:
+            return
+        breakers = {
+            name: CircuitBreaker(
+                name,
+                failure_threshold=self.valves.breaker_failure_threshold,
+                reset_timeout=self.valves.breaker_reset_timeout,
+                half_open_probes=self.valves.breaker_half_open_probes,
+            )
+            for name in ("embedder", "vector_store", "llm")
+        }
+        breakers["embedder"].guard(memory.embedding_model, "embed")
+        for method in ("search", "insert", "update", "delete", "get", "list"):
+            breakers["vector_store"].guard(memory.vector_store, method)
+        breakers["llm"].guard(memory.llm, "generate_response")
+        if getattr(memory, "graph", None) is not None:
+            breakers["graph"] = CircuitBreaker(
+                "graph",
+                failure_threshold=self.valves.breaker_failure_threshold,
+                reset_timeout=self.valves.breaker_reset_timeout,
+                half_open_probes=self.valves.breaker_half_open_probes,
+            )
+            breakers["graph"].guard(memory.graph, "search")
+            breakers["graph"].guard(memory.graph, "add")
+        self.breakers[id(memory)] = breakers
+
     async def init_mem_zero(self):
+        limits = self.connection_limits()
+        if self.valves.qdrant_path:
+            qdrant_client = self.reuse_client(
+                "qdrant", ("embedded", self.valves.qdrant_path), self.embedded_qdrant
+            )
+        else:
+            qdrant_client = self.reuse_client(
+                "qdrant",
+                (
+                    self.valves.qdrant_host,
+                    self.valves.qdrant_port,
+                    self.valves.qdrant_prefer_grpc,
+                    self.valves.qdrant_grpc_port,
+                    self.valves.qdrant_timeout,
+                    limits.max_connections,
+                    limits.max_keepalive_connections,
+                    limits.keepalive_expiry,
+                ),
+                lambda: QdrantClient(
+                    host=self.valves.qdrant_host,
+                    port=int(self.valves.qdrant_port),
+                    grpc_port=self.valves.qdrant_grpc_port,
+                    prefer_grpc=self.valves.qdrant_prefer_grpc,
+                    timeout=self.valves.qdrant_timeout,
+                    limits=limits,
+                ),
+            )
         config = {
             "vector_store": {
                 "provider": "qdrant",
@@ -193,6 +2621,7 @@ class Pipeline:
                     "host": self.valves.qdrant_host,
                     "port": self.valves.qdrant_port,
                     "collection_name": self.valves.collection_name,
+                    "client": qdrant_client,
                 },
             },
             "llm": {
@@ -213,4 +2642,33 @@ class Pipeline:
         }
 
         print("Initializing memory with config:", config)
-        return await AsyncMemory.from_config(config)
+        with self.metrics.time("client_init"):
+            memory = await AsyncMemory.from_config(config)
+        self.use_http_pool(memory.llm)
+        self.use_http_pool(memory.embedding_model)
+        await asyncio.to_thread(self.partition_vector_store, memory)
+        # Time the backend calls mem0 makes from its worker threads
+        self.metrics.instrument(memory.embedding_model, "embed", "embed")
+        self.metrics.instrument(memory.vector_store, "search", "vector_search")
+        self.metrics.instrument(memory.vector_store, "insert", "vector_insert")
+        self.metrics.instrument(memory.vector_store, "update", "vector_update")
+        self.metrics.instrument(memory.llm, "generate_response", "llm")
+        if self.valves.graph_enabled:
+            memory.graph = await asyncio.to_thread(self.build_graph, config)
+            self.metrics.instrument(memory.graph, "search", "graph_search")
+            self.metrics.instrument(memory.graph, "add", "graph_add")
+        # Behind the cache, so cached embeddings are served during an outage
+        self.guard_memory(memory)
+        if self.valves.embedding_cache_size > 0:
+            # Search and add embed the same text; memoize so each costs one call
+            memory.embedding_model = CachedEmbedder(
+                memory.embedding_model,
+                max_entries=self.valves.embedding_cache_size,
+                path=self.valves.embedding_cache_path,
+            )
+        # Outermost, so every error mem0 swallows during an add is seen
+        BackendFailures.track(memory.embedding_model, "embed")
+        for method in ("search", "insert", "update", "delete", "get", "list"):
+            BackendFailures.track(memory.vector_store, method)
+        BackendFailures.track(memory.llm, "generate_response")
+        return memory